@@ -0,0 +1,95 @@
+# USAGE
+# python benchmark.py
+# python benchmark.py --video videos/example_01.mp4 --roi 120 60 24 60
+#
+# Compares the per-update cost and the memory of the raw gray-scale and the HOG KCFTracker modes,
+# single and multi-scale, and the memory per tracker of a KCFTrackerBank.
+# Without a video, a textured block moving over a noisy background is tracked, and the run fails if a
+# tracker locked on that steady target is ever marked as lost, or a tiny target gets a non-finite PSR.
+
+import argparse
+import time
+import cv2
+import numpy as np
+import kcftracker
+
+
+def synthetic_frames(count=100, size=(240, 320), step=2):
+	rng = np.random.RandomState(0)
+	background = cv2.GaussianBlur((rng.rand(size[0], size[1]) * 255).astype(np.uint8), (7, 7), 0)
+	target = (rng.rand(60, 24) * 255).astype(np.uint8)
+	frames = []
+	for i in range(count):
+		frame = background.copy()
+		x = 40 + step * i % (size[1] - 64)
+		frame[80:140, x:x + 24] = target
+		frames.append(frame)
+	return frames, [40, 80, 24, 60]
+
+
+def video_frames(path_to_video, count):
+	camera = cv2.VideoCapture(path_to_video)
+	frames = []
+	while len(frames) < count:
+		(grabbed, frame) = camera.read()
+		if not grabbed:
+			break
+		frames.append(cv2.cvtColor(frame, cv2.COLOR_BGR2GRAY))
+	camera.release()
+	return frames
+
+
+def benchmark(frames, roi, hog, fixed_window, multiscale=False):
+	tracker = kcftracker.KCFTracker(hog, fixed_window, multiscale)
+	tracker.init(roi, frames[0])
+	dfts = tracker.dft_count
+	start_time = time.time()
+	for frame in frames[1:]:
+		tracker.update(frame)
+	updates = len(frames) - 1
+	return (time.time() - start_time) / updates, (tracker.dft_count - dfts) / float(updates), tracker
+
+
+def check_steady(frames, roi):
+	# regression check of the tracking confidence on a clean clip: a locked tracker is never marked bad
+	tracker = kcftracker.KCFTracker(False, False)
+	tracker.init(roi, frames[0])
+	bank = kcftracker.KCFTrackerBank()
+	banked = bank.add(roi, frames[0])
+	tiny = bank.add([60, 90, 4, 6], frames[0])  # response map smaller than the excluded square of the PSR
+	for i, frame in enumerate(frames[1:]):
+		tracker.update(frame)
+		bank.update(frame)
+		assert not tracker.isTrackingBad(), 'steady tracker marked bad at update {}, psr {:.2f}'.format(i, tracker.psr)
+		assert not banked.isTrackingBad(), 'steady bank tracker marked bad at update {}, psr {:.2f}'.format(i, banked.psr)
+		assert np.isfinite(tiny.psr), 'tiny tracker psr {} at update {}'.format(tiny.psr, i)
+
+
+if __name__ == '__main__':
+	ap = argparse.ArgumentParser()
+	ap.add_argument("-v", "--video", help="path to the video file", nargs=1)
+	ap.add_argument("-r", "--roi", help="initial target x y w h (with --video)", nargs=4, type=int)
+	ap.add_argument("-n", "--frames", help="number of frames", type=int, default=100)
+	args = ap.parse_args()
+
+	if args.video is not None:
+		frames = video_frames(args.video[0], args.frames)
+		roi = args.roi
+	else:
+		frames, roi = synthetic_frames(args.frames)
+		check_steady(*synthetic_frames(args.frames, step=1))
+		print("--- steady target: never marked bad")
+
+	for name, hog in (('raw', False), ('hog', True)):
+		for fixed_window, multiscale in ((False, False), (True, False), (True, True)):
+			update_time, dfts, tracker = benchmark(frames, roi, hog, fixed_window, multiscale)
+			print("--- {} fixed_window={} multiscale={}: {:.3f} ms/update, {:.1f} DFTs/update, patch {}, fft {}, {:.1f} KiB".format(
+				name, fixed_window, multiscale, update_time * 1000, dfts, tracker.size_patch, tracker.fft.name,
+				tracker.memoryUsage() / 1024.))
+
+	bank = kcftracker.KCFTrackerBank()
+	for i in range(10):
+		bank.add([roi[0] + 3 * i, roi[1], roi[2], roi[3]], frames[0])
+	for frame in frames[1:]:
+		bank.update(frame)
+	print("--- bank: {} trackers, {:.1f} KiB per tracker".format(len(bank), bank.memoryUsage() / 1024. / len(bank)))
@@ -0,0 +1,69 @@
+import threading
+import cv2
+
+# Capture stage
+# Reads a camera (or a video file) in its own thread, so decoding overlaps with the processing of the
+# previous frame. Skipped frames are only grab()bed, never decoded. The newest frame waits in a single
+# slot: with drop=True (a live camera) a frame nobody took in time is replaced by the next one, so the
+# processing loop never falls behind the camera; with drop=False (a video file) the thread waits for
+# the slot to be taken instead, so every kept frame is processed.
+
+
+class FrameCapture:
+	def __init__(self, source, skip=0, drop=True):
+		# source: a cv2.VideoCapture source (device index or path), skip: frames grabbed and dropped
+		# before every kept one
+		self.camera = cv2.VideoCapture(source)
+		self.skip = skip
+		self.drop = drop
+		self.captured = 0  # kept frames read from the camera
+		self.dropped = 0  # kept frames replaced in the slot before being taken
+		self._cond = threading.Condition()
+		self._frame = None  # the slot
+		self._ended = False
+		self._stopped = False
+		self._thread = threading.Thread(target=self._run, daemon=True)
+
+	def start(self):
+		self._thread.start()
+		return self
+
+	def _run(self):
+		while not self._stopped:
+			grabbed = True
+			for repeat in range(self.skip):
+				grabbed = self.camera.grab()
+				if not grabbed:
+					break
+			frame = None
+			if grabbed:
+				(grabbed, frame) = self.camera.read()
+			with self._cond:
+				if not grabbed:
+					self._ended = True
+					self._cond.notify_all()
+					return
+				while not self.drop and self._frame is not None and not self._stopped:
+					self._cond.wait()
+				if self._frame is not None:
+					self.dropped += 1
+				self._frame = frame
+				self.captured += 1
+				self._cond.notify_all()
+
+	def read(self, timeout=None):
+		# (grabbed, frame) like cv2.VideoCapture.read(): waits for a frame newer than the last one read,
+		# grabbed is False at the end of the stream, after release() or on timeout
+		with self._cond:
+			self._cond.wait_for(lambda: self._frame is not None or self._ended or self._stopped, timeout)
+			frame = self._frame
+			self._frame = None
+			self._cond.notify_all()
+		return (frame is not None, frame)
+
+	def release(self):
+		with self._cond:
+			self._stopped = True
+			self._cond.notify_all()
+		self._thread.join()
+		self.camera.release()
@@ -0,0 +1,138 @@
+import queue
+import threading
+import traceback
+
+# Bounded executors
+# Short units of work (motion callbacks, image uploads, control messages, snapshots) run on named pools
+# of worker threads behind bounded queues, instead of one new thread each: under a burst the number of
+# threads and the memory stay flat, and what does not fit is handled by the overflow policy
+#   block        the caller waits for room
+#   drop_newest  the new task is dropped
+#   drop_oldest  the oldest queued task is dropped for the new one
+#   caller_runs  the new task runs right away in the caller's thread
+# Every executor counts its tasks and the depth of its queue (see stats() and report()).
+
+OVERFLOW = ('block', 'drop_newest', 'drop_oldest', 'caller_runs')
+
+_executors = {}  # name -> BoundedExecutor
+_lock = threading.RLock()  # get() creates the executor while holding it
+
+
+class BoundedExecutor:
+	def __init__(self, name, workers=1, queue_size=16, overflow='block'):
+		assert overflow in OVERFLOW
+		self.name = name
+		self.overflow = overflow
+		self.submitted = 0
+		self.completed = 0
+		self.failed = 0
+		self.dropped = 0
+		self.max_depth = 0
+		self._queue = queue.Queue(queue_size)
+		self._lock = threading.Lock()
+		self._threads = [threading.Thread(target=self._run, name='{}-{}'.format(name, i), daemon=True)
+						 for i in range(workers)]
+		for thread in self._threads:
+			thread.start()
+		with _lock:
+			_executors[name] = self
+
+	def submit(self, fn, *args, dropped=None):
+		# runs fn(*args) on a worker; dropped() is called if the overflow policy drops the task, now or
+		# later (drop_oldest); returns False when the task was dropped right away
+		task = (fn, args, dropped)
+		with self._lock:
+			self.submitted += 1
+		if self.overflow == 'block':
+			self._queue.put(task)
+		else:
+			try:
+				self._queue.put_nowait(task)
+			except queue.Full:
+				if self.overflow == 'caller_runs':
+					self._call(task)
+					return True
+				if self.overflow == 'drop_newest':
+					self._drop(task)
+					return False
+				try:
+					self._drop(self._queue.get_nowait())
+				except queue.Empty:
+					pass
+				try:
+					self._queue.put_nowait(task)
+				except queue.Full:
+					self._drop(task)  # the other submitters refilled it
+					return False
+		with self._lock:
+			self.max_depth = max(self.max_depth, self._queue.qsize())
+		return True
+
+	def _drop(self, task):
+		with self._lock:
+			self.dropped += 1
+		if task[2] is not None:
+			task[2]()
+
+	def _call(self, task):
+		(fn, args, dropped) = task
+		try:
+			fn(*args)
+		except Exception:
+			traceback.print_exc()
+			with self._lock:
+				self.failed += 1
+			return
+		with self._lock:
+			self.completed += 1
+
+	def _run(self):
+		while True:
+			task = self._queue.get()
+			if task is None:
+				return
+			self._call(task)
+
+	def stats(self):
+		with self._lock:
+			return {'name': self.name, 'workers': len(self._threads), 'depth': self._queue.qsize(),
+					'max_depth': self.max_depth, 'submitted': self.submitted, 'completed': self.completed,
+					'failed': self.failed, 'dropped': self.dropped}
+
+	def shutdown(self):
+		# runs the queued tasks, then stops the workers
+		for thread in self._threads:
+			self._queue.put(None)
+		for thread in self._threads:
+			thread.join()
+		with _lock:
+			if _executors.get(self.name) is self:
+				del _executors[self.name]
+
+
+def get(name, workers=1, queue_size=16, overflow='block'):
+	# the executor called name, created with these parameters by the first call
+	with _lock:
+		executor = _executors.get(name)
+		if executor is None:
+			executor = BoundedExecutor(name, workers, queue_size, overflow)
+		return executor
+
+
+def named(name, settings):
+	# the executor called name, as configured in the [executors] section of settings (a settings.Settings)
+	cfg = settings.executors
+	return get(name, getattr(cfg, name + '_workers'), getattr(cfg, name + '_queue_size'),
+			   getattr(cfg, name + '_overflow'))
+
+
+def stats():
+	with _lock:
+		executors = list(_executors.values())
+	return [executor.stats() for executor in executors]
+
+
+def report():
+	# one line: name(depth/max_depth, completed, failed, dropped) of every executor
+	return ', '.join('{name}({depth}/{max_depth}, {completed} done, {failed} failed, {dropped} dropped)'.format(**s)
+					 for s in stats())
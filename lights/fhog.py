@@ -0,0 +1,132 @@
+import numpy as np
+import cv2
+import functools
+
+# Felzenszwalb HOG features, as used by KCFTracker(hog=True).
+# Same maps (and the same mapp dict interface) as the fhog port of the original KCF tracker,
+# but every stage is vectorized with NumPy instead of looping over pixels and cells in Python.
+# The only difference: a gradient lying exactly between two orientation sectors (e.g. a purely
+# vertical one) may be binned into the other sector.
+
+# Globals
+NUM_SECTOR = 9
+FLT_EPSILON = 1e-07
+
+
+def getFeatureMaps(image, k, mapp):
+	# image: (m,n) or (m,n,c), k: cell size
+	# mapp['map']: (sizeY * sizeX * 27) float32, per cell 9 contrast insensitive + 18 sensitive orientations
+	kernel = np.array([[-1., 0., 1.]], np.float32)
+	height = image.shape[0]
+	width = image.shape[1]
+	sizeX = width // k
+	sizeY = height // k
+	p = 3 * NUM_SECTOR
+
+	image = np.float32(image)
+	dx = cv2.filter2D(image, -1, kernel)
+	dy = cv2.filter2D(image, -1, kernel.T)
+	if (image.ndim == 3):
+		# the channel with the strongest gradient wins
+		magnitude = dx * dx + dy * dy
+		c = np.argmax(magnitude, axis=2)[:, :, None]
+		dx = np.take_along_axis(dx, c, axis=2)[:, :, 0]
+		dy = np.take_along_axis(dy, c, axis=2)[:, :, 0]
+	r = np.sqrt(dx * dx + dy * dy)
+
+	# orientation sector: the sector boundary (every pi / NUM_SECTOR) with the largest projection of the
+	# gradient, i.e. its angle rounded to the nearest boundary; negative side -> sector + NUM_SECTOR
+	angle = np.arctan2(dy, dx)
+	alfa1 = np.rint(angle * (NUM_SECTOR / np.pi)).astype(np.int64) % (2 * NUM_SECTOR)  # contrast sensitive, 0..17
+
+	# every pixel votes for its sensitive orientation with r, spread bilinearly over 4 cells;
+	# the insensitive histogram is the sensitive one folded in half
+	ys, xs, cells, weights = _votingGeometry(height, width, k)
+	votes = (weights * r[ys, xs].ravel()).ravel()
+	bins = (cells + alfa1[ys, xs].ravel()).ravel()
+	hist = np.bincount(bins, votes, minlength=(sizeY + 2) * (sizeX + 2) * 2 * NUM_SECTOR)
+	hist = hist.reshape((sizeY + 2, sizeX + 2, 2 * NUM_SECTOR))[1:-1, 1:-1]
+
+	mapp['sizeX'] = sizeX
+	mapp['sizeY'] = sizeY
+	mapp['numFeatures'] = p
+	mapp['map'] = np.concatenate((hist[:, :, :NUM_SECTOR] + hist[:, :, NUM_SECTOR:], hist),
+								 axis=2).astype(np.float32).ravel()
+	return mapp
+
+
+@functools.lru_cache(maxsize=32)
+def _votingGeometry(height, width, k):
+	# voting pixels (not on the image border, inside the cell grid) as slices, and for each of them the
+	# 4 cells it votes for, as bin offsets into a (sizeY + 2, sizeX + 2, 18) histogram whose border
+	# cells catch the votes falling outside the grid, and the matching bilinear weights; both (4, N)
+	sizeX = width // k
+	sizeY = height // k
+	half = k // 2
+	nearest = np.ones(k, np.int64)
+	nearest[0:half] = -1
+	a_x = np.concatenate((half - np.arange(half) - 0.5, np.arange(half, k) - half + 0.5)).astype(np.float32)
+	b_x = np.concatenate((half + np.arange(half) + 0.5, -np.arange(half, k) + half - 0.5 + k)).astype(np.float32)
+	w = np.stack((b_x / (a_x + b_x), a_x / (a_x + b_x)), axis=1)  # (k, 2) own cell, nearest neighbour cell
+
+	ys = slice(1, min(height - 1, sizeY * k))
+	xs = slice(1, min(width - 1, sizeX * k))
+	y, x = np.mgrid[ys, xs]
+	y, x = y.ravel(), x.ravel()
+	i, ii = y // k + 1, y % k
+	j, jj = x // k + 1, x % k
+
+	cells = []
+	weights = []
+	for di, wi in ((0, w[ii, 0]), (nearest[ii], w[ii, 1])):
+		for dj, wj in ((0, w[jj, 0]), (nearest[jj], w[jj, 1])):
+			cells.append(((i + di) * (sizeX + 2) + j + dj) * 2 * NUM_SECTOR)
+			weights.append(wi * wj)
+	return ys, xs, np.array(cells), np.array(weights, np.float32)
+
+
+def normalizeAndTruncate(mapp, alfa):
+	# normalizes every cell by the energy of its 4 surrounding 2x2 blocks and truncates at alfa
+	# drops the border cells: (sizeY - 2) * (sizeX - 2) cells of 4 * 27 = 108 features
+	sizeX = mapp['sizeX']
+	sizeY = mapp['sizeY']
+	p = NUM_SECTOR
+
+	cells = mapp['map'].reshape((sizeY, sizeX, mapp['numFeatures']))
+	partOfNorm = np.sum(cells[:, :, :p] ** 2, axis=2)
+	blocks = partOfNorm[:-1, :-1] + partOfNorm[:-1, 1:] + partOfNorm[1:, :-1] + partOfNorm[1:, 1:]
+	blocks = np.sqrt(blocks) + FLT_EPSILON
+	norms = (blocks[1:, 1:], blocks[:-1, 1:], blocks[1:, :-1], blocks[:-1, :-1])
+
+	inner = cells[1:-1, 1:-1]
+	newData = np.concatenate([inner[:, :, :p] / n[:, :, None] for n in norms] +
+							 [inner[:, :, p:] / n[:, :, None] for n in norms], axis=2)
+	np.minimum(newData, alfa, out=newData)
+
+	mapp['numFeatures'] = 12 * p
+	mapp['sizeX'] = sizeX - 2
+	mapp['sizeY'] = sizeY - 2
+	mapp['map'] = newData.astype(np.float32).ravel()
+	return mapp
+
+
+def PCAFeatureMaps(mapp):
+	# analytic projection of the 108 normalized features down to 31 per cell:
+	# 18 sensitive + 9 insensitive orientations summed over the 4 norms, plus 4 per-norm energies
+	sizeX = mapp['sizeX']
+	sizeY = mapp['sizeY']
+	xp = NUM_SECTOR
+	yp = 4
+	nx = 1.0 / np.sqrt(xp * 2)
+	ny = 1.0 / np.sqrt(yp)
+
+	cells = mapp['map'].reshape((sizeY, sizeX, mapp['numFeatures']))
+	insensitive = cells[:, :, :yp * xp].reshape((sizeY, sizeX, yp, xp))
+	sensitive = cells[:, :, yp * xp:].reshape((sizeY, sizeX, yp, 2 * xp))
+	newData = np.concatenate((sensitive.sum(axis=2) * ny,
+							  insensitive.sum(axis=2) * ny,
+							  sensitive.sum(axis=3) * nx), axis=2)
+
+	mapp['numFeatures'] = 3 * xp + yp
+	mapp['map'] = newData.astype(np.float32).ravel()
+	return mapp
@@ -1,27 +1,28 @@
 import numpy as np
 import cv2
-from configparser import ConfigParser
+import functools
+import inspect
+import sys
+import time
+import fhog
+import multiprocessing as mp
+from multiprocessing import resource_tracker, shared_memory
+import settings as config
 
 # import ip_configuration as IP
 
-# import fhog
-
 # Globals
-config_filename = 'config.ini'
-config_parser = None
-
-
-def get_config():
-	global config_parser
-	config_parser = ConfigParser()
-	config_parser.read(config_filename)
+WINDOW_CACHE_SIZE = 32  # number of distinct patch sizes kept in the window caches
+WORKSPACE_SIZE = 32  # max number of buffers kept in a tracker workspace
 
 
 # ffttools
-def fftd(img, backwards=False):
+# The kernels below take an optional out= buffer; with it they write their result there instead of
+# allocating a new array, which is how KCFTracker runs them on its per-tracker workspace.
+def fftd(img, backwards=False, out=None):
 	# shape of img can be (m,n), (m,n,1) or (m,n,2)	
 	# in my test, fft provided by numpy and scipy are slower than cv2.dft
-	return cv2.dft(np.float32(img), flags=(
+	return cv2.dft(np.asarray(img, np.float32), dst=out, flags=(
 	(cv2.DFT_INVERSE | cv2.DFT_SCALE) if backwards else cv2.DFT_COMPLEX_OUTPUT))  # 'flags =' is necessary!
 
 
@@ -33,31 +34,233 @@ def imag(img):
 	return img[:, :, 1]
 
 
-def complexMultiplication(a, b):
-	res = np.zeros(a.shape, a.dtype)
-
-	res[:, :, 0] = a[:, :, 0] * b[:, :, 0] - a[:, :, 1] * b[:, :, 1]
-	res[:, :, 1] = a[:, :, 0] * b[:, :, 1] + a[:, :, 1] * b[:, :, 0]
-	return res
-
-
-def complexDivision(a, b):
-	res = np.zeros(a.shape, a.dtype)
-	divisor = 1. / (b[:, :, 0] ** 2 + b[:, :, 1] ** 2)
-
-	res[:, :, 0] = (a[:, :, 0] * b[:, :, 0] + a[:, :, 1] * b[:, :, 1]) * divisor
-	res[:, :, 1] = (a[:, :, 1] * b[:, :, 0] + a[:, :, 0] * b[:, :, 1]) * divisor
-	return res
+def complexDivision(a, b, out=None, tmp=None):
+	# tmp: optional (m,n) scratch buffer for the divisor; out must not alias a or b
+	if out is None:
+		out = np.empty(a.shape, a.dtype)
+	if tmp is None:
+		tmp = np.empty(a.shape[:2], a.dtype)
+	np.multiply(b[:, :, 0], b[:, :, 0], out=tmp)
+	np.multiply(b[:, :, 1], b[:, :, 1], out=out[:, :, 0])  # out is scratch until the product below
+	tmp += out[:, :, 0]
+	cv2.mulSpectrums(a, b, 0, c=out, conjB=True)  # a * conj(b)
+	out[:, :, 0] /= tmp  # per channel, broadcasting tmp would buffer it
+	out[:, :, 1] /= tmp
+	return out
 
 
-def rearrange(img):
+def rearrange(img, out=None):
 	# return np.fft.fftshift(img, axes=(0,1))
 	assert (img.ndim == 2)
-	img_ = np.zeros(img.shape, img.dtype)
-	xh, yh = img.shape[1] / 2, img.shape[0] / 2
-	img_[0:yh, 0:xh], img_[yh:img.shape[0], xh:img.shape[1]] = img[yh:img.shape[0], xh:img.shape[1]], img[0:yh, 0:xh]
-	img_[0:yh, xh:img.shape[1]], img_[yh:img.shape[0], 0:xh] = img[yh:img.shape[0], 0:xh], img[0:yh, xh:img.shape[1]]
-	return img_
+	if out is None:
+		out = np.empty(img.shape, img.dtype)
+	xh, yh = img.shape[1] // 2, img.shape[0] // 2
+	out[0:yh, 0:xh], out[yh:img.shape[0], xh:img.shape[1]] = img[yh:img.shape[0], xh:img.shape[1]], img[0:yh, 0:xh]
+	out[0:yh, xh:img.shape[1]], out[yh:img.shape[0], 0:xh] = img[yh:img.shape[0], 0:xh], img[0:yh, xh:img.shape[1]]
+	return out
+
+
+def interpolate(dst, src, factor):
+	# dst = (1 - factor) * dst + factor * src, in place; dst must be contiguous
+	if np.iscomplexobj(dst):
+		dst, src = dst.view(np.float32), np.ascontiguousarray(src).view(np.float32)
+	d2, s2 = dst.reshape(dst.shape[0], -1), src.reshape(src.shape[0], -1)
+	cv2.addWeighted(d2, 1 - factor, s2, factor, 0, dst=d2)
+	return dst
+
+
+# FFT backends
+# KCFTracker does all of its frequency-domain work through one of these. They share an interface
+# (forward/inverse transforms plus the spectral products the tracker needs) but not a spectrum
+# layout, so spectra must only be mixed with spectra of the same backend.
+#   cv2         cv2.dft, full spectrum as (m,n,2) float32 (the original layout)
+#   numpy       numpy.fft (pocketfft), full spectrum as (m,n) complex64
+#   numpy_real  numpy.fft real transforms, half-spectrum (m,n/2+1) complex64 using Hermitian symmetry
+_NP_FFT_OUT = 'out' in inspect.signature(np.fft.fft2).parameters  # numpy >= 2.0
+
+
+class CvFFT:
+	name = 'cv2'
+	dtype = np.float32
+
+	def spectrumShape(self, rows, cols):
+		return (rows, cols, 2)
+
+	def forward(self, x, out=None):
+		# x: (m,n) or a stack (...,m,n) of real feature maps
+		if x.ndim > 2:
+			if out is None:
+				out = np.empty(x.shape + (2,), np.float32)
+			xs, outs = x.reshape((-1,) + x.shape[-2:]), out.reshape((-1,) + out.shape[-3:])
+			for i in range(xs.shape[0]):
+				fftd(xs[i], out=outs[i])
+			return out
+		return fftd(x, out=out)
+
+	def inverse(self, xf, shape, out=None):
+		# xf: (m,n,2) or a stack (...,m,n,2)
+		if xf.ndim > 3:
+			if out is None:
+				out = np.empty(xf.shape[:-3] + tuple(shape), np.float32)
+			xfs, outs = xf.reshape((-1,) + xf.shape[-3:]), out.reshape((-1,) + tuple(shape))
+			for i in range(xfs.shape[0]):
+				self.inverse(xfs[i], shape, outs[i])
+			return out
+		return cv2.dft(xf, dst=out, flags=(cv2.DFT_INVERSE | cv2.DFT_SCALE | cv2.DFT_REAL_OUTPUT))
+
+	def mul(self, a, b, out=None, conjB=False):
+		if a.ndim > 3 or b.ndim > 3:
+			# (...,m,n,2) stacks, one of them may be a single spectrum broadcast over the other
+			if out is None:
+				out = np.empty(a.shape if a.ndim > b.ndim else b.shape, np.float32)
+			for i in np.ndindex(out.shape[:-3]):
+				cv2.mulSpectrums(a[i] if a.ndim > 3 else a, b[i] if b.ndim > 3 else b, 0, c=out[i], conjB=conjB)
+			return out
+		return cv2.mulSpectrums(a, b, 0, c=out, conjB=conjB)
+
+	def crossSum(self, a, b, out=None, tmp=None):
+		# sum over the channel axis of a * conj(b); (m,n,2) float32 is viewed as (m,n) complex64
+		if out is None:
+			out = np.empty(a.shape[:-4] + a.shape[-3:], np.float32)
+		if tmp is not None:
+			tmp = tmp.view(np.complex64)[..., 0]
+		crossSum(a.view(np.complex64)[..., 0], b.view(np.complex64)[..., 0], out.view(np.complex64)[..., 0], tmp)
+		return out
+
+	def div(self, a, b, out=None, tmp=None):
+		if a.ndim > 3 or b.ndim > 3:
+			# stacks as in mul, tmp: optional (...,m,n) scratch
+			if out is None:
+				out = np.empty(a.shape if a.ndim > b.ndim else b.shape, np.float32)
+			for i in np.ndindex(out.shape[:-3]):
+				complexDivision(a[i] if a.ndim > 3 else a, b[i] if b.ndim > 3 else b, out[i],
+								None if tmp is None else tmp[i])
+			return out
+		return complexDivision(a, b, out, tmp)
+
+	def regularize(self, xf, value):
+		xf[..., 0] += value
+		return xf
+
+
+class NumpyFFT:
+	name = 'numpy'
+	dtype = np.complex64
+
+	def spectrumShape(self, rows, cols):
+		return (rows, cols)
+
+	def _transform(self, func, x, out, **kwargs):
+		if _NP_FFT_OUT and out is not None:
+			return func(x, out=out, **kwargs)
+		res = func(x, **kwargs)
+		return res.astype(self.dtype, copy=False) if np.iscomplexobj(res) else res.astype(np.float32, copy=False)
+
+	def forward(self, x, out=None):
+		return self._transform(np.fft.fft2, x, out)
+
+	def inverse(self, xf, shape, out=None):
+		if out is None:
+			return np.fft.ifft2(xf).real.astype(np.float32)
+		np.copyto(out, np.fft.ifft2(xf).real, casting='unsafe')
+		return out
+
+	def mul(self, a, b, out=None, conjB=False):
+		if conjB:
+			if out is None or out.shape != b.shape:  # b broadcast over a stack
+				return np.multiply(a, np.conj(b), out=out)
+			np.conj(b, out=out)
+			return np.multiply(a, out, out=out)
+		return np.multiply(a, b, out=out)
+
+	def crossSum(self, a, b, out=None, tmp=None):
+		return crossSum(a, b, out, tmp)
+
+	def div(self, a, b, out=None, tmp=None):
+		return np.divide(a, b, out=out)
+
+	def regularize(self, xf, value):
+		xf += value
+		return xf
+
+
+class NumpyRealFFT(NumpyFFT):
+	name = 'numpy_real'
+
+	def spectrumShape(self, rows, cols):
+		return (rows, cols // 2 + 1)
+
+	def forward(self, x, out=None):
+		return self._transform(np.fft.rfft2, x, out)
+
+	def inverse(self, xf, shape, out=None):
+		return self._transform(np.fft.irfft2, xf, out, s=shape)
+
+
+def crossSum(a, b, out=None, tmp=None):
+	# sum over the channel axis of a * conj(b), for complex (c,m,n) spectra or (s,c,m,n) stacks of them,
+	# b may be a single (c,m,n) spectrum broadcast over the stack; tmp: optional scratch shaped like a
+	if tmp is None or tmp.shape != b.shape:
+		tmp = np.multiply(a, np.conj(b), out=tmp)
+	else:
+		np.conj(b, out=tmp)
+		np.multiply(a, tmp, out=tmp)
+	return np.sum(tmp, axis=-3, out=out)
+
+
+FFT_BACKENDS = {'cv2': CvFFT(), 'numpy': NumpyFFT(), 'numpy_real': NumpyRealFFT()}
+
+
+@functools.lru_cache(maxsize=WINDOW_CACHE_SIZE)
+def autotuneFFT(rows, cols, repeat=20):
+	# times a correlation cycle (forward, spectral product, inverse) of every backend on this device,
+	# once per patch size, and returns the name of the fastest one
+	x = np.random.rand(rows, cols).astype(np.float32) - 0.5
+	out = np.empty((rows, cols), np.float32)
+	timings = {}
+	for name, fft in FFT_BACKENDS.items():
+		xf = fft.forward(x)
+		prod = np.empty_like(xf)
+		start = time.perf_counter()
+		for _ in range(repeat):
+			fft.inverse(fft.mul(fft.forward(x, xf), xf, prod, conjB=True), (rows, cols), out)
+		timings[name] = time.perf_counter() - start
+	return min(timings, key=timings.get)
+
+
+def optimalDFTSize(n):
+	# smallest even size >= n made of the small prime factors (2, 3, 5) the DFTs are fast on
+	n = cv2.getOptimalDFTSize(n)
+	while n % 2:
+		n = cv2.getOptimalDFTSize(n + 1)
+	return n
+
+
+# window cache
+# Targets at a fixed camera distance keep producing the same few patch sizes, so the Hann windows
+# and Gaussian target spectra are computed once per size and shared, read-only, by all trackers.
+@functools.lru_cache(maxsize=WINDOW_CACHE_SIZE)
+def hannWindow(rows, cols):
+	hann2t, hann1t = np.ogrid[0:rows, 0:cols]
+	hann1t = 0.5 * (1 - np.cos(2 * np.pi * hann1t / (cols - 1)))
+	hann2t = 0.5 * (1 - np.cos(2 * np.pi * hann2t / (rows - 1)))
+	hann2d = (hann2t * hann1t).astype(np.float32)
+	hann2d.setflags(write=False)
+	return hann2d
+
+
+@functools.lru_cache(maxsize=WINDOW_CACHE_SIZE)
+def gaussianPeakSpectrum(rows, cols, padding, output_sigma_factor, backend='cv2'):
+	# in the spectrum layout of FFT_BACKENDS[backend]
+	syh, sxh = rows // 2, cols // 2
+	output_sigma = np.sqrt(cols * rows) / padding * output_sigma_factor
+	mult = -0.5 / (output_sigma * output_sigma)
+	y, x = np.ogrid[0:rows, 0:cols]
+	y, x = (y - syh) ** 2, (x - sxh) ** 2
+	res = np.exp(mult * (y + x)).astype(np.float32)
+	spectrum = FFT_BACKENDS[backend].forward(res)
+	spectrum.setflags(write=False)
+	return spectrum
 
 
 # recttools
@@ -97,7 +300,8 @@ def getBorder(original, limited):
 	return res
 
 
-def subwindow(img, window, borderType=cv2.BORDER_CONSTANT):
+def subwindow(img, window, borderType=cv2.BORDER_CONSTANT, out=None):
+	# out: optional (window[3], window[2]) buffer, only written when the window crosses the image border
 	cutWindow = [x for x in window]
 	limit(cutWindow, [0, 0, img.shape[1], img.shape[0]])  # modify cutWindow
 	assert (cutWindow[2] > 0 and cutWindow[3] > 0)
@@ -105,23 +309,101 @@ def subwindow(img, window, borderType=cv2.BORDER_CONSTANT):
 	res = img[cutWindow[1]:cutWindow[1] + cutWindow[3], cutWindow[0]:cutWindow[0] + cutWindow[2]]
 
 	if (border != [0, 0, 0, 0]):
-		res = cv2.copyMakeBorder(res, border[1], border[3], border[0], border[2], borderType)
+		res = cv2.copyMakeBorder(res, border[1], border[3], border[0], border[2], borderType, dst=out)
 	return res
 
 
+def entranceSnapshot(image, roi, margin=10, size=64):
+	# copy of the roi plus margin pixels around it, downscaled so that its longer side is at most size
+	# (0 keeps the resolution); a tracker keeps this instead of the whole frame it started on
+	window = [int(roi[0]) - margin, int(roi[1]) - margin, int(roi[2]) + 2 * margin, int(roi[3]) + 2 * margin]
+	limit(window, [0, 0, image.shape[1], image.shape[0]])
+	if (window[2] <= 0 or window[3] <= 0):
+		return None
+	crop = image[window[1]:y2(window), window[0]:x2(window)]
+	scale = size / float(max(window[2], window[3])) if size else 1.
+	if (scale < 1):
+		dsize = (max(1, int(round(window[2] * scale))), max(1, int(round(window[3] * scale))))
+		return cv2.resize(crop, dsize, interpolation=cv2.INTER_AREA)
+	return crop.copy()
+
+
+# tracking confidence
+def peakToSidelobe(res, py, px, excluded=5):
+	# peak-to-sidelobe ratio of (n,rows,cols) response maps with their peaks at (py, px), both (n,):
+	# how far the peak stands out of the responses outside a (2 * excluded + 1) square around it.
+	# On small maps (small targets, HOG cell grids) the square is shrunk to a quarter of the map side so a
+	# sidelobe is left; a map with no sidelobe at all (1 pixel) gets a PSR of 0, a low-confidence detection
+	# that never enters the running statistics
+	rows, cols = res.shape[1], res.shape[2]
+	excluded = min(excluded, min(rows, cols) // 4)
+	# sidelobe sums = whole map sums - peak square sums, without (n,rows,cols) temporaries
+	total = res.sum(axis=(1, 2)).astype(np.float64)
+	total2 = np.einsum('nij,nij->n', res, res).astype(np.float64)
+	n = np.full(res.shape[0], rows * cols)
+	for i in range(res.shape[0]):
+		y, x = int(py[i]), int(px[i])
+		peak = res[i, max(y - excluded, 0):y + excluded + 1, max(x - excluded, 0):x + excluded + 1]
+		n[i] -= peak.size
+		total[i] -= peak.sum(dtype=np.float64)
+		total2[i] -= np.square(peak, dtype=np.float64).sum()
+	safe = np.maximum(n, 1)
+	mean = total / safe
+	var = total2 / safe - mean * mean
+	psr = (res[np.arange(res.shape[0]), py, px] - mean) / (np.sqrt(np.maximum(var, 0)) + 1e-5)
+	return np.where(n > 0, psr, 0.)
+
+
 # KCF tracker
 class KCFTracker:
-	def __init__(self, hog=False, fixed_window=True, multiscale=False):
-
-		get_config()
+	# many trackers live at once on a small device, so no per-instance __dict__
+	__slots__ = ('lambdar', 'padding', 'output_sigma_factor', 'min_movement', 'nonmoving_lifetime', 'fft_backend',
+				 'optimal_dft_size', 'entrance_frame', 'entrance_margin', 'entrance_size',
+				 'motion_model', 'velocity_gain', 'velocity_limit', '_vx', '_vy',
+				 'psr_threshold', 'psr_sigmas', 'psr_warmup', 'psr_std_floor', 'bad_tracking_lifetime', 'psr', '_psr_count', '_psr_mean', '_psr_m2',
+				 'bad_tracking_ctr', 'not_moving_ctr', 'is_not_moving',
+				 'interp_factor', 'sigma', 'cell_size', '_hogfeatures',
+				 'template_size', 'scale_step', 'scale_weight', 'scale_interval', 'scale_stability',
+				 '_tmpl_sz', '_roi', 'size_patch', '_scale', 'fft', '_alphaf', '_prob', '_tmpl', 'hann',
+				 '_tmplf', '_tmpl_energy', 'dft_count', 'update_dfts', '_peak_value', '_scale_peak', '_scale_age',
+				 '_workspace', '_age', '_dist')
+
+	def __init__(self, hog=False, fixed_window=True, multiscale=False, settings=None):
+		# settings: a settings.Settings, config.ini by default
+		cfg = (settings or config.load()).tracker
 
 		self.lambdar = 0.0001  # regularization
-		self.padding = config_parser.getfloat('tracker', 'window_padding')  # 2.5   # extra area surrounding the target
-		self.output_sigma_factor = config_parser.getfloat('tracker',
-														  'sigma_factor')  # 0.125   # bandwidth of gaussian target
-		self.min_movement = config_parser.getint('tracker', 'min_movement')
-		self.nonmoving_lifetime = config_parser.getint('tracker', 'nonmoving_lifetime')
-		self.entrance_frame = None
+		self.padding = cfg.window_padding  # 2.5   # extra area surrounding the target
+		self.output_sigma_factor = cfg.sigma_factor  # 0.125   # bandwidth of gaussian target
+		self.min_movement = cfg.min_movement
+		self.nonmoving_lifetime = cfg.nonmoving_lifetime
+		self.fft_backend = cfg.fft_backend  # auto or a FFT_BACKENDS name
+		self.optimal_dft_size = cfg.optimal_dft_size
+		self.entrance_frame = None  # entranceSnapshot() of the first frame
+		self.entrance_margin = cfg.entrance_margin
+		self.entrance_size = cfg.entrance_size
+		self._age = 0
+		self._dist = 0
+
+		# constant-velocity motion model: the search window is centred on the predicted position, so a
+		# steady target stays near the window centre and a smaller window_padding still keeps fast movers
+		self.motion_model = cfg.motion_model
+		self.velocity_gain = cfg.velocity_gain
+		self.velocity_limit = cfg.velocity_limit  # fraction of the padded window
+		self._vx = 0.  # estimated velocity, pixels per update
+		self._vy = 0.
+
+		# tracking confidence: the peak-to-sidelobe ratio (PSR) of every detection and its running statistics
+		self.psr_threshold = cfg.psr_threshold  # absolute floor
+		self.psr_sigmas = cfg.psr_sigmas  # drop below the running mean, in std
+		self.psr_warmup = cfg.psr_warmup  # confident detections before the drop is tested
+		self.psr_std_floor = cfg.psr_std_floor  # std floor, relative to the mean
+		self.bad_tracking_lifetime = cfg.bad_tracking_lifetime
+		self.psr = 0.  # PSR of the last detection
+		self._psr_count = 0  # Welford running mean / variance of the PSR over the confident detections
+		self._psr_mean = 0.
+		self._psr_m2 = 0.
+		self.bad_tracking_ctr = 0  # consecutive low-confidence detections
 
 		# idan 28.10
 		self.not_moving_ctr = 0
@@ -135,8 +417,8 @@ class KCFTracker:
 			self.cell_size = 4  # HOG cell size
 			self._hogfeatures = True
 		else:  # raw gray-scale image # aka CSK tracker
-			self.interp_factor = config_parser.getfloat('tracker', 'interp_factor')  # 0.075
-			self.sigma = config_parser.getfloat('tracker', 'sigma')  # 0.2
+			self.interp_factor = cfg.interp_factor  # 0.075
+			self.sigma = cfg.sigma  # 0.2
 			self.cell_size = 1
 			self._hogfeatures = False
 
@@ -144,6 +426,8 @@ class KCFTracker:
 			self.template_size = 96  # template size
 			self.scale_step = 1.05  # scale step for multi-scale estimation
 			self.scale_weight = 0.96  # to downweight detection scores of other scales for added stability
+			self.scale_interval = cfg.scale_interval  # frames between scale tests while the peak is stable
+			self.scale_stability = cfg.scale_stability
 		elif (fixed_window):
 			self.template_size = 96
 			self.scale_step = 1
@@ -155,64 +439,134 @@ class KCFTracker:
 		self._roi = [0., 0., 0., 0.]  # cv::Rect2f, [x,y,width,height]  #[float,float,float,float]
 		self.size_patch = [0, 0, 0]  # [int,int,int]
 		self._scale = 1.  # float
-		self._alphaf = None  # numpy.ndarray    (size_patch[0], size_patch[1], 2)
-		self._prob = None  # numpy.ndarray    (size_patch[0], size_patch[1], 2)
+		self.fft = None  # FFT backend, chosen per patch size by init(); the spectra below use its layout
+		self._alphaf = None  # numpy.ndarray    cv2: (size_patch[0], size_patch[1], 2)
+		self._prob = None  # numpy.ndarray    cv2: (size_patch[0], size_patch[1], 2)
 		self._tmpl = None  # numpy.ndarray    raw: (size_patch[0], size_patch[1])   hog: (size_patch[2], size_patch[0]*size_patch[1])
 		self.hann = None  # numpy.ndarray    raw: (size_patch[0], size_patch[1])   hog: (size_patch[2], size_patch[0]*size_patch[1])
 
+		# frequency-domain state: spectrum and energy of _tmpl, kept in step with it by train()
+		self._tmplf = None  # numpy.ndarray    cv2 raw: (size_patch[0], size_patch[1], 2)   cv2 hog: (size_patch[2], size_patch[0], size_patch[1], 2)
+		self._tmpl_energy = 0.  # float    sum(_tmpl ** 2)
+		self.dft_count = 0  # DFTs done by this tracker
+		self.update_dfts = 0  # DFTs done by the last update()
+
+		self._peak_value = 0.  # response peak of the last update()
+		self._scale_peak = 0.  # response peak of the last scale test
+		self._scale_age = 0  # updates since the last scale test
+
+		self._workspace = {}  # (name, shape, dtype) -> numpy.ndarray, scratch buffers reused across updates
+
+	def updateConfidence(self, psr):
+		# a detection is of low confidence when its PSR is under psr_threshold, or psr_sigmas standard deviations
+		# under the running mean; only the confident ones feed the running statistics. The drop is only tested
+		# after psr_warmup confident detections, and against a std of at least psr_std_floor times the mean: the
+		# first PSRs of a steady target are nearly identical, and their std alone would flag normal jitter
+		self.psr = psr
+		low = psr < self.psr_threshold
+		if (self._psr_count >= self.psr_warmup):
+			std = max(np.sqrt(self._psr_m2 / (self._psr_count - 1)), self.psr_std_floor * self._psr_mean)
+			low = low or psr < self._psr_mean - self.psr_sigmas * std
+		if (low):
+			self.bad_tracking_ctr += 1
+			return
+		self.bad_tracking_ctr = 0
+		self._psr_count += 1
+		delta = psr - self._psr_mean
+		self._psr_mean += delta / self._psr_count
+		self._psr_m2 += delta * (psr - self._psr_mean)
+
+	def resetConfidence(self):
+		self.psr = 0.
+		self._psr_count = 0
+		self._psr_mean = 0.
+		self._psr_m2 = 0.
+		self.bad_tracking_ctr = 0
+
+	def testScales(self):
+		# the other scales are tested every scale_interval frames, or right away once the peak drops below
+		# scale_stability times the one at the last test (e.g. the target is getting nearer or further)
+		return (self._scale_age + 1 >= self.scale_interval or
+				self._peak_value < self.scale_stability * self._scale_peak)
+
 	def subPixelPeak(self, left, center, right):
 		divisor = 2 * center - right - left  # float
 		return (0 if abs(divisor) < 1e-3 else 0.5 * (right - left) / divisor)
 
 	def createHanningMats(self):
-		hann2t, hann1t = np.ogrid[0:self.size_patch[0], 0:self.size_patch[1]]
-
-		hann1t = 0.5 * (1 - np.cos(2 * np.pi * hann1t / (self.size_patch[1] - 1)))
-		hann2t = 0.5 * (1 - np.cos(2 * np.pi * hann2t / (self.size_patch[0] - 1)))
-		hann2d = hann2t * hann1t
+		hann2d = hannWindow(self.size_patch[0], self.size_patch[1])
 
 		if (self._hogfeatures):
 			hann1d = hann2d.reshape(self.size_patch[0] * self.size_patch[1])
 			self.hann = np.zeros((self.size_patch[2], 1), np.float32) + hann1d
 		else:
-			self.hann = hann2d
-		self.hann = self.hann.astype(np.float32)
+			self.hann = hann2d  # shared and read-only
 
 	def createGaussianPeak(self, sizey, sizex):
-		syh, sxh = sizey / 2, sizex / 2
-		output_sigma = np.sqrt(sizex * sizey) / self.padding * self.output_sigma_factor
-		mult = -0.5 / (output_sigma * output_sigma)
-		y, x = np.ogrid[0:sizey, 0:sizex]
-		y, x = (y - syh) ** 2, (x - sxh) ** 2
-		res = np.exp(mult * (y + x))
-		return fftd(res)
-
-	def gaussianCorrelation(self, x1, x2):
+		return gaussianPeakSpectrum(sizey, sizex, self.padding, self.output_sigma_factor, self.fft.name)
+
+	def selectFFT(self):
+		if (self.fft_backend == 'auto'):
+			return FFT_BACKENDS[autotuneFFT(self.size_patch[0], self.size_patch[1])]
+		return FFT_BACKENDS[self.fft_backend]
+
+	def workspace(self, name, shape, dtype=np.float32):
+		# preallocated scratch buffer, reused by every update until the patch size changes
+		key = (name, shape, dtype)
+		buf = self._workspace.get(key)
+		if buf is None:
+			if len(self._workspace) >= WORKSPACE_SIZE:  # stale sizes, e.g. after multiscale changes
+				self._workspace.clear()
+			buf = self._workspace[key] = np.empty(shape, dtype)
+		return buf
+
+	def spectrumBuffer(self, name, *lead):
+		# workspace buffer holding a spectrum in the layout of the current backend,
+		# lead: leading stack dimensions, e.g. the HOG channels and/or the tested scales
+		shape = self.fft.spectrumShape(self.size_patch[0], self.size_patch[1])
+		return self.workspace(name, lead + shape, self.fft.dtype)
+
+	def forward(self, x, out=None):
+		# counting wrappers around the backend transforms
+		self.dft_count += x.size // (x.shape[-2] * x.shape[-1])
+		return self.fft.forward(x, out)
+
+	def inverse(self, xf, out=None):
+		rows, cols = self.size_patch[0], self.size_patch[1]
+		res = self.fft.inverse(xf, (rows, cols), out)
+		self.dft_count += res.size // (rows * cols)
+		return res
+
+	def spectrum(self, x, name='xf'):
+		# spectrum of a feature map, per channel for HOG features, in the workspace buffer 'name'
+		rows, cols = self.size_patch[0], self.size_patch[1]
 		if (self._hogfeatures):
-			c = np.zeros((self.size_patch[0], self.size_patch[1]), np.float32)
-			for i in xrange(self.size_patch[2]):
-				x1aux = x1[i, :].reshape((self.size_patch[0], self.size_patch[1]))
-				x2aux = x2[i, :].reshape((self.size_patch[0], self.size_patch[1]))
-				caux = cv2.mulSpectrums(fftd(x1aux), fftd(x2aux), 0, conjB=True)
-				caux = real(fftd(caux, True))
-				# caux = rearrange(caux)
-				c += caux
-			c = rearrange(c)
+			return self.forward(x.reshape((self.size_patch[2], rows, cols)), self.spectrumBuffer(name, self.size_patch[2]))
+		return self.forward(x, self.spectrumBuffer(name))
+
+	def spectralCorrelation(self, x1f, x1_energy, x2f, x2_energy, scales=()):
+		# Gaussian kernel correlation of two feature patches, from their spectra and energies
+		# scales: (s,) to correlate a stack of s spectra x1f (with s energies) against the single x2f
+		rows, cols = self.size_patch[0], self.size_patch[1]
+		name = 'scales_' if scales else ''
+		cf = self.spectrumBuffer(name + 'cf', *scales)
+		if (self._hogfeatures):
+			# the inverse DFT is linear, so all channels are multiplied and summed in the frequency
+			# domain in one batched pass, followed by a single inverse DFT
+			self.fft.crossSum(x1f, x2f, cf, self.spectrumBuffer(name + 'caux', *(scales + (self.size_patch[2],))))
 		else:
-			c = cv2.mulSpectrums(fftd(x1), fftd(x2), 0, conjB=True)  # 'conjB=' is necessary!
-			c = fftd(c, True)
-			c = real(c)
-			c = rearrange(c)
-
-		if (x1.ndim == 3 and x2.ndim == 3):
-			d = (np.sum(x1[:, :, 0] * x1[:, :, 0]) + np.sum(x2[:, :, 0] * x2[:, :, 0]) - 2.0 * c) / (
-			self.size_patch[0] * self.size_patch[1] * self.size_patch[2])
-		elif (x1.ndim == 2 and x2.ndim == 2):
-			d = (np.sum(x1 * x1) + np.sum(x2 * x2) - 2.0 * c) / (
-			self.size_patch[0] * self.size_patch[1] * self.size_patch[2])
-
-		d = d * (d >= 0)
-		d = np.exp(-d / (self.sigma * self.sigma))
+			self.fft.mul(x1f, x2f, cf, conjB=True)
+		c = self.inverse(cf, self.workspace(name + 'c', scales + (rows, cols)))
+		d = self.workspace(name + 'k', scales + (rows, cols))
+		for i in np.ndindex(scales):
+			rearrange(c[i], d[i])
+
+		# d = exp(-max(x1_energy + x2_energy - 2c, 0) / (N * sigma^2)), in place
+		d *= -2.0
+		d += np.reshape(np.add(x1_energy, x2_energy), scales + (1, 1))
+		np.maximum(d, 0, out=d)
+		d *= -1. / (self.size_patch[0] * self.size_patch[1] * self.size_patch[2] * self.sigma * self.sigma)
+		np.exp(d, out=d)
 
 		return d
 
@@ -238,50 +592,80 @@ class KCFTracker:
 				self._scale = 1.
 
 			if (self._hogfeatures):
-				self._tmpl_sz[0] = int(self._tmpl_sz[0]) / (
+				self._tmpl_sz[0] = int(self._tmpl_sz[0]) // (
 				2 * self.cell_size) * 2 * self.cell_size + 2 * self.cell_size
-				self._tmpl_sz[1] = int(self._tmpl_sz[1]) / (
+				self._tmpl_sz[1] = int(self._tmpl_sz[1]) // (
 				2 * self.cell_size) * 2 * self.cell_size + 2 * self.cell_size
 			else:
-				self._tmpl_sz[0] = int(self._tmpl_sz[0]) / 2 * 2
-				self._tmpl_sz[1] = int(self._tmpl_sz[1]) / 2 * 2
+				self._tmpl_sz[0] = int(self._tmpl_sz[0]) // 2 * 2
+				self._tmpl_sz[1] = int(self._tmpl_sz[1]) // 2 * 2
+				if (self.optimal_dft_size):  # e.g. 98x62 instead of a slow prime-factor 97x61
+					self._tmpl_sz[0] = optimalDFTSize(self._tmpl_sz[0])
+					self._tmpl_sz[1] = optimalDFTSize(self._tmpl_sz[1])
 
 		extracted_roi[2] = int(scale_adjust * self._scale * self._tmpl_sz[0])
 		extracted_roi[3] = int(scale_adjust * self._scale * self._tmpl_sz[1])
 		extracted_roi[0] = int(cx - extracted_roi[2] / 2)
 		extracted_roi[1] = int(cy - extracted_roi[3] / 2)
 
-		z = subwindow(image, extracted_roi, cv2.BORDER_REPLICATE)
+		if (inithann):
+			self._workspace.clear()  # new patch size
+
+		z = subwindow(image, extracted_roi, cv2.BORDER_REPLICATE,
+					  self.workspace('window', (extracted_roi[3], extracted_roi[2]) + image.shape[2:], image.dtype))
 		if (z.shape[1] != self._tmpl_sz[0] or z.shape[0] != self._tmpl_sz[1]):
-			z = cv2.resize(z, tuple(self._tmpl_sz))
+			z = cv2.resize(z, tuple(self._tmpl_sz),
+						   dst=self.workspace('resized', (self._tmpl_sz[1], self._tmpl_sz[0]) + z.shape[2:], z.dtype))
 
 		if (self._hogfeatures):
 			mapp = {'sizeX': 0, 'sizeY': 0, 'numFeatures': 0, 'map': 0}
 			mapp = fhog.getFeatureMaps(z, self.cell_size, mapp)
 			mapp = fhog.normalizeAndTruncate(mapp, 0.2)
 			mapp = fhog.PCAFeatureMaps(mapp)
-			self.size_patch = map(int, [mapp['sizeY'], mapp['sizeX'], mapp['numFeatures']])
+			self.size_patch = [int(mapp['sizeY']), int(mapp['sizeX']), int(mapp['numFeatures'])]
 			FeaturesMap = mapp['map'].reshape((self.size_patch[0] * self.size_patch[1],
 											   self.size_patch[2])).T  # (size_patch[2], size_patch[0]*size_patch[1])
 		else:
 			if (z.ndim == 3 and z.shape[2] == 3):
-				FeaturesMap = cv2.cvtColor(z,
-										   cv2.COLOR_BGR2GRAY)  # z:(size_patch[0], size_patch[1], 3)  FeaturesMap:(size_patch[0], size_patch[1])   #np.int8  #0~255
-			elif (z.ndim == 2):
-				FeaturesMap = z  # (size_patch[0], size_patch[1]) #np.int8  #0~255
-			FeaturesMap = FeaturesMap.astype(np.float32) / 255.0 - 0.5
+				z = cv2.cvtColor(z, cv2.COLOR_BGR2GRAY, dst=self.workspace('gray', z.shape[:2], z.dtype))  # z:(size_patch[0], size_patch[1], 3)  FeaturesMap:(size_patch[0], size_patch[1])   #np.int8  #0~255
+			FeaturesMap = self.workspace('features', z.shape)  # (size_patch[0], size_patch[1]) #np.int8  #0~255
+			np.multiply(z, np.float32(1. / 255), out=FeaturesMap)
+			FeaturesMap -= 0.5
 			self.size_patch = [z.shape[0], z.shape[1], 1]
 
 		if (inithann):
 			self.createHanningMats()  # createHanningMats need size_patch
 
-		FeaturesMap = self.hann * FeaturesMap
+		FeaturesMap *= self.hann
 		return FeaturesMap
 
-	def detect(self, z, x):
-		k = self.gaussianCorrelation(x, z)
-		res = real(fftd(complexMultiplication(self._alphaf, fftd(k)), True))
-
+	def detect(self, x):
+		# correlate the features x with the template, whose spectrum and energy are kept by train()
+		k = self.spectralCorrelation(self.spectrum(x), cv2.norm(x, cv2.NORM_L2SQR), self._tmplf, self._tmpl_energy)
+		kf = self.forward(k, self.spectrumBuffer('kf'))
+		resf = self.fft.mul(self._alphaf, kf, self.spectrumBuffer('resf'))
+		res = self.inverse(resf, self.workspace('res', (self.size_patch[0], self.size_patch[1])))
+		return self.peak(res)
+
+	def detectScales(self, xs):
+		# detect for a stack of feature maps, e.g. the patches of several scales, in one batched pass:
+		# stacked DFTs and spectral products against the shared template spectrum and alphaf
+		rows, cols = self.size_patch[0], self.size_patch[1]
+		s = xs.shape[0]
+		if (self._hogfeatures):
+			xf = self.forward(xs.reshape((s, self.size_patch[2], rows, cols)),
+							  self.spectrumBuffer('scales_xf', s, self.size_patch[2]))
+		else:
+			xf = self.forward(xs, self.spectrumBuffer('scales_xf', s))
+		energies = np.array([cv2.norm(x, cv2.NORM_L2SQR) for x in xs])
+		k = self.spectralCorrelation(xf, energies, self._tmplf, self._tmpl_energy, (s,))
+		kf = self.forward(k, self.spectrumBuffer('scales_kf', s))
+		resf = self.fft.mul(self._alphaf, kf, self.spectrumBuffer('scales_resf', s))
+		res = self.inverse(resf, self.workspace('scales_res', (s, rows, cols)))
+		return [self.peak(r) for r in res]
+
+	def peak(self, res):
+		# sub-pixel location of the response peak relative to the patch centre, its value and its PSR
 		_, pv, _, pi = cv2.minMaxLoc(res)  # pv:float  pi:tuple of int
 		p = [float(pi[0]), float(pi[1])]  # cv::Point2f, [x,y]  #[float,float]
 
@@ -293,28 +677,49 @@ class KCFTracker:
 		p[0] -= res.shape[1] / 2.
 		p[1] -= res.shape[0] / 2.
 
-		return p, pv
+		psr = float(peakToSidelobe(res[None], np.array([pi[1]]), np.array([pi[0]]))[0])
+		return p, pv, psr
 
 	def train(self, x, train_interp_factor):
-		k = self.gaussianCorrelation(x, x)
-		alphaf = complexDivision(self._prob, fftd(k) + self.lambdar)
-
-		self._tmpl = (1 - train_interp_factor) * self._tmpl + train_interp_factor * x
-		self._alphaf = (1 - train_interp_factor) * self._alphaf + train_interp_factor * alphaf
+		rows, cols = self.size_patch[0], self.size_patch[1]
+		xf = self.spectrum(x)
+		x_energy = cv2.norm(x, cv2.NORM_L2SQR)
+		k = self.spectralCorrelation(xf, x_energy, xf, x_energy)
+		kf = self.fft.regularize(self.forward(k, self.spectrumBuffer('kf')), self.lambdar)
+		alphaf = self.fft.div(self._prob, kf, self.spectrumBuffer('alphaf'), self.workspace('divisor', (rows, cols)))
+
+		interpolate(self._tmpl, x, train_interp_factor)
+		interpolate(self._alphaf, alphaf, train_interp_factor)
+		# the DFT is linear, so the template spectrum follows the same interpolation
+		interpolate(self._tmplf, xf, train_interp_factor)
+		self._tmpl_energy = cv2.norm(self._tmpl, cv2.NORM_L2SQR)
 
 	def init(self, roi, image):
-		self._roi = map(float, roi)
+		self._roi = [float(v) for v in roi]
 		assert (roi[2] > 0 and roi[3] > 0)
-		self._tmpl = self.getFeatures(image, 1)
+		self._tmpl = self.getFeatures(image, 1).copy()  # getFeatures returns a workspace buffer
+		self.fft = self.selectFFT()
 		self._prob = self.createGaussianPeak(self.size_patch[0], self.size_patch[1])
-		self._alphaf = np.zeros((self.size_patch[0], self.size_patch[1], 2), np.float32)
+		self._alphaf = np.zeros_like(self.spectrumBuffer('alphaf'))
+		if (self._hogfeatures):
+			self._tmplf = np.zeros_like(self.spectrumBuffer('xf', self.size_patch[2]))
+		else:
+			self._tmplf = np.zeros_like(self.spectrumBuffer('xf'))
 		self._age = 0
 		self._dist = 0
 		self.train(self._tmpl, 1.0)
 
-		self.entrance_frame = image
+		self.entrance_frame = entranceSnapshot(image, roi, self.entrance_margin, self.entrance_size)
 
 	def update(self, image):
+		dft_count = self.dft_count
+		px = self._vx if self.motion_model else 0.  # predicted shift
+		py = self._vy if self.motion_model else 0.
+		pcx = self._roi[0] + self._roi[2] / 2.
+		pcy = self._roi[1] + self._roi[3] / 2.
+		self._roi[0] += px
+		self._roi[1] += py
+
 		if (self._roi[0] + self._roi[2] <= 0):  self._roi[0] = -self._roi[2] + 1
 		if (self._roi[1] + self._roi[3] <= 0):  self._roi[1] = -self._roi[2] + 1
 		if (self._roi[0] >= image.shape[1] - 1):  self._roi[0] = image.shape[1] - 2
@@ -323,30 +728,41 @@ class KCFTracker:
 		cx = self._roi[0] + self._roi[2] / 2.
 		cy = self._roi[1] + self._roi[3] / 2.
 
-		loc, peak_value = self.detect(self._tmpl, self.getFeatures(image, 0, 1.0))
-
-		if (self.scale_step != 1):
-			# Test at a smaller _scale
-			new_loc1, new_peak_value1 = self.detect(self._tmpl, self.getFeatures(image, 0, 1.0 / self.scale_step))
-			# Test at a bigger _scale
-			new_loc2, new_peak_value2 = self.detect(self._tmpl, self.getFeatures(image, 0, self.scale_step))
+		if (self.scale_step != 1 and self.testScales()):
+			# current, smaller and bigger _scale, extracted together and detected in one batched pass
+			x = self.getFeatures(image, 0, 1.0)
+			xs = self.workspace('scales', (3,) + x.shape)
+			xs[0] = x
+			xs[1] = self.getFeatures(image, 0, 1.0 / self.scale_step)
+			xs[2] = self.getFeatures(image, 0, self.scale_step)
+			(loc, peak_value, psr), (new_loc1, new_peak_value1, psr1), (new_loc2, new_peak_value2, psr2) = self.detectScales(xs)
+			self._scale_peak = peak_value
+			self._scale_age = 0
 
 			if (self.scale_weight * new_peak_value1 > peak_value and new_peak_value1 > new_peak_value2):
 				loc = new_loc1
 				peak_value = new_peak_value1
+				psr = psr1
 				self._scale /= self.scale_step
 				self._roi[2] /= self.scale_step
 				self._roi[3] /= self.scale_step
 			elif (self.scale_weight * new_peak_value2 > peak_value):
 				loc = new_loc2
 				peak_value = new_peak_value2
+				psr = psr2
 				self._scale *= self.scale_step
 				self._roi[2] *= self.scale_step
 				self._roi[3] *= self.scale_step
+		else:
+			loc, peak_value, psr = self.detect(self.getFeatures(image, 0, 1.0))
+			self._scale_age += 1
+		self._peak_value = peak_value
+		self.updateConfidence(psr)
+		move = [loc[0] + px / (self.cell_size * self._scale), loc[1] + py / (self.cell_size * self._scale)]
 
 		# idan
 
-		if loc[0] < self.min_movement and loc[1] < self.min_movement:
+		if move[0] < self.min_movement and move[1] < self.min_movement:
 			self.not_moving_ctr += 1
 		else:
 			self.not_moving_ctr = 0
@@ -361,15 +777,24 @@ class KCFTracker:
 		if (self._roi[0] + self._roi[2] <= 0):  self._roi[0] = -self._roi[2] + 2
 		if (self._roi[1] + self._roi[3] <= 0):  self._roi[1] = -self._roi[3] + 2
 		assert (self._roi[2] > 0 and self._roi[3] > 0)
+		if (self.bad_tracking_ctr == 0):
+			# only confident detections update the velocity, a drifting one would throw the next window off
+			self._vx += self.velocity_gain * (self._roi[0] + self._roi[2] / 2. - pcx - self._vx)
+			self._vy += self.velocity_gain * (self._roi[1] + self._roi[3] / 2. - pcy - self._vy)
+			limit_x = self.velocity_limit * self._roi[2] * self.padding  # the padded window of getFeatures
+			limit_y = self.velocity_limit * self._roi[3]
+			self._vx = min(max(self._vx, -limit_x), limit_x)
+			self._vy = min(max(self._vy, -limit_y), limit_y)
 
 		x = self.getFeatures(image, 0, 1.0)
 		self.train(x, self.interp_factor)
 
 		self._age += 1
-		self._dist += loc[0]  # only in x axis
+		self._dist += move[0]  # only in x axis
 
-		self._roi = map(int, self._roi)
+		self._roi = [int(v) for v in self._roi]
 
+		self.update_dfts = self.dft_count - dft_count
 		return self._roi
 
 	# return isEdge(self._roi, [image.shape[0], image.shape[1]])isEdge
@@ -386,5 +811,479 @@ class KCFTracker:
 	def isNotMoving(self):
 		return self.is_not_moving
 
+	def isTrackingBad(self):
+		# lost target: bad_tracking_lifetime low-confidence detections in a row
+		return self.bad_tracking_ctr >= self.bad_tracking_lifetime
+
+	def isConfident(self):
+		# the last detection was of high confidence
+		return self.bad_tracking_ctr == 0
+
+	def getEntranceFrame(self):
+		return self.entrance_frame
+
+	def memoryUsage(self):
+		# bytes held by this tracker alone: the object, its templates, workspace and entrance snapshot;
+		# the cached Hann windows and Gaussian spectra are shared by all trackers of a size and not counted
+		arrays = [self._tmpl, self._tmplf, self._alphaf, self.entrance_frame] + list(self._workspace.values())
+		if (self._hogfeatures):
+			arrays.append(self.hann)  # per tracker, tiled over the channels
+		return sys.getsizeof(self) + sum(a.nbytes for a in arrays if a is not None)
+
+
+# Batched multi-target KCF engine
+# The padded window of every target is resampled to one square template of template_size pixels, so
+# all live targets, whatever their size, share one group: the templates and _alphaf spectra of the
+# targets are stacked along axis 0 (plus one shared Hann window and Gaussian target spectrum), and
+# feature correlation, the FFTs and peak finding run once per frame instead of once per tracker. A
+# shift found in the template is scaled back to the image by the window size of its target. The
+# frequency-domain work goes through the FFT backend of the group, picked like KCFTracker.selectFFT.
+class _TrackerGroup:
+	__slots__ = ('size', 'fft', 'trackers', 'tmpl', 'alphaf', 'tmplf', 'tmpl_energy', 'hann', 'prob', '_workspace')
+
+	def __init__(self, size, padding, output_sigma_factor, fft):
+		self.size = size  # (rows, cols)
+		self.fft = fft
+		self.trackers = []
+		self.tmpl = np.zeros((0,) + size, np.float32)  # (n, rows, cols)
+		self.alphaf = np.zeros((0,) + fft.spectrumShape(*size), fft.dtype)  # (n,) + spectrum shape
+		self.tmplf = np.zeros_like(self.alphaf)  # spectra of tmpl
+		self.tmpl_energy = np.zeros(0, np.float32)  # (n,) sum(tmpl ** 2)
+		self.hann = hannWindow(size[0], size[1])
+		self.prob = gaussianPeakSpectrum(size[0], size[1], padding, output_sigma_factor, fft.name)
+		self._workspace = {}
+
+	def __len__(self):
+		return len(self.trackers)
+
+	def workspace(self, name, shape, dtype=np.float32):
+		# preallocated buffer of the group kernels, reused every frame until the number of trackers changes
+		key = (name, shape, dtype)
+		buf = self._workspace.get(key)
+		if buf is None:
+			buf = self._workspace[key] = np.empty(shape, dtype)
+		return buf
+
+	def stack(self, name, n):
+		# workspace buffer holding n feature maps, (n, rows, cols)
+		return self.workspace(name, (n,) + self.size)
+
+	def spectrumStack(self, name, n):
+		# workspace buffer holding n spectra in the layout of the group backend
+		return self.workspace(name, (n,) + self.fft.spectrumShape(*self.size), self.fft.dtype)
+
+
+class KCFTrackerBank:
+	def __init__(self, template_size=None, settings=None):
+		self.settings = settings or config.load()
+		cfg = self.settings.tracker
+		if template_size is None:
+			template_size = cfg.bank_template_size
+		template_size = max(2, template_size // 2 * 2)  # template sizes must stay even
+		self.lambdar = 0.0001  # regularization
+		self.padding = cfg.window_padding
+		self.output_sigma_factor = cfg.sigma_factor
+		self.interp_factor = cfg.interp_factor
+		self.sigma = cfg.sigma
+		self.motion_model = cfg.motion_model
+		self.velocity_gain = cfg.velocity_gain
+		self.velocity_limit = cfg.velocity_limit
+		self.fft_backend = cfg.fft_backend
+		size = (template_size, template_size)
+		self._group = _TrackerGroup(size, self.padding, self.output_sigma_factor, self.selectFFT(size))
+
+	def selectFFT(self, size):
+		if (self.fft_backend == 'auto'):
+			return FFT_BACKENDS[autotuneFFT(size[0], size[1])]
+		return FFT_BACKENDS[self.fft_backend]
+
+	def __iter__(self):
+		# iterate over a snapshot, callers remove trackers while looping
+		return iter(list(self._group.trackers))
+
+	def __len__(self):
+		return len(self._group)
+
+	def _windows(self, rois):
+		# the padded windows of KCFTracker.getFeatures with template_size == 1, (n, 2) widths and heights
+		rois = np.asarray(rois, np.float64).reshape(-1, 4)
+		return np.maximum(1, np.stack((rois[:, 2] * self.padding, rois[:, 3]), axis=1).astype(np.int64))
+
+	def _extract(self, group, image, rois):
+		# Hann-windowed gray-scale features of the padded windows of the targets, each resampled to the
+		# template, in the (n, rows, cols) 'x' buffer of the group
+		rows, cols = group.size
+		feats = group.stack('x', len(rois))
+		for i, (roi, (w, h)) in enumerate(zip(rois, self._windows(rois).tolist())):
+			cx = roi[0] + roi[2] / 2.
+			cy = roi[1] + roi[3] / 2.
+			z = subwindow(image, [int(cx - w / 2), int(cy - h / 2), w, h], cv2.BORDER_REPLICATE)
+			# area averaging when shrinking, bilinear sampling would alias the texture of large targets
+			shrink = z.shape[0] * z.shape[1] > rows * cols
+			interpolation = cv2.INTER_AREA if shrink else cv2.INTER_LINEAR
+			if z.ndim == 3:
+				z = cv2.resize(z, (cols, rows), dst=group.workspace('resized', (rows, cols) + z.shape[2:], z.dtype),
+							   interpolation=interpolation)
+				z = cv2.cvtColor(z, cv2.COLOR_BGR2GRAY, dst=group.workspace('gray', (rows, cols), z.dtype))
+			else:
+				z = cv2.resize(z, (cols, rows), dst=group.workspace('gray', (rows, cols), z.dtype),
+							   interpolation=interpolation)
+			x = np.multiply(z, np.float32(1. / 255), out=feats[i])
+			x -= 0.5
+			x *= group.hann  # per map, broadcasting over the stack would buffer it
+		return feats
+
+	def _energy(self, group, name, x):
+		# (n,) sum(x ** 2) of a stack of feature maps
+		return np.einsum('nij,nij->n', x, x, out=group.workspace(name, (len(x),)))
+
+	def _correlation(self, group, xf, x_energy, zf, z_energy):
+		# batched KCFTracker.spectralCorrelation: xf/zf are (n,) stacks of spectra, energies are (n,)
+		n = len(xf)
+		rows, cols = group.size
+		cf = group.fft.mul(xf, zf, group.spectrumStack('cf', n), conjB=True)
+		c = group.fft.inverse(cf, group.size, group.stack('c', n))
+		d = group.stack('k', n)
+		for i in range(n):
+			rearrange(c[i], d[i])
+
+		# d = exp(-max(x_energy + z_energy - 2c, 0) / (N * sigma^2)), in place
+		energy = np.add(x_energy, z_energy, out=group.workspace('energy', (n,)))
+		for i in range(n):
+			d[i] *= -2.0
+			d[i] += energy[i]  # per map, broadcasting over the stack would buffer it
+		np.maximum(d, 0, out=d)
+		d *= -1. / (rows * cols * self.sigma * self.sigma)
+		np.exp(d, out=d)
+		return d
+
+	def _train(self, group, x, interp_factor, rows=slice(None)):
+		n = len(x)
+		xf = group.fft.forward(x, group.spectrumStack('xf', n))
+		x_energy = self._energy(group, 'x_energy', x)
+		k = self._correlation(group, xf, x_energy, xf, x_energy)
+		kf = group.fft.regularize(group.fft.forward(k, group.spectrumStack('kf', n)), self.lambdar)
+		alphaf = group.fft.div(group.prob, kf, group.spectrumStack('alphaf', n), group.stack('divisor', n))
+
+		interpolate(group.tmpl[rows], x, interp_factor)
+		interpolate(group.alphaf[rows], alphaf, interp_factor)
+		interpolate(group.tmplf[rows], xf, interp_factor)
+		np.einsum('nij,nij->n', group.tmpl[rows], group.tmpl[rows], out=group.tmpl_energy[rows])
+
+	def add(self, roi, image, tracker=None):
+		# tracker: re-seed this (removed) tracker instead of creating one, keeping its age and history
+		t = tracker
+		if t is None:
+			t = KCFTracker(False, False, False, self.settings)
+			t.entrance_frame = entranceSnapshot(image, roi, t.entrance_margin, t.entrance_size)
+		t._roi = [float(v) for v in roi]
+		assert (roi[2] > 0 and roi[3] > 0)
+
+		group = self._group
+		size = group.size
+		t._tmpl_sz = [size[1], size[0]]
+		t.size_patch = [size[0], size[1], 1]
+
+		group._workspace.clear()  # new tracker count
+		x = self._extract(group, image, [t._roi])
+		group.trackers.append(t)
+		group.tmpl = np.concatenate((group.tmpl, x))
+		group.alphaf = np.concatenate((group.alphaf, np.zeros((1,) + group.alphaf.shape[1:], group.fft.dtype)))
+		group.tmplf = np.concatenate((group.tmplf, np.zeros((1,) + group.tmplf.shape[1:], group.fft.dtype)))
+		group.tmpl_energy = np.append(group.tmpl_energy, np.float32(0))
+		self._train(group, x, 1.0, slice(-1, None))
+		return t
+
+	def remove(self, tracker):
+		group = self._group
+		i = group.trackers.index(tracker)
+		del group.trackers[i]
+		group._workspace.clear()  # new tracker count
+		group.tmpl = np.delete(group.tmpl, i, axis=0)
+		group.alphaf = np.delete(group.alphaf, i, axis=0)
+		group.tmplf = np.delete(group.tmplf, i, axis=0)
+		group.tmpl_energy = np.delete(group.tmpl_energy, i)
+
+	def memoryUsage(self, tracker=None):
+		# bytes held by one tracker (its share of the group arrays included), or by all of them
+		if tracker is None:
+			return sum(self.memoryUsage(t) for t in self)
+		group = self._group
+		shared = group.tmpl.nbytes + group.alphaf.nbytes + group.tmplf.nbytes + group.tmpl_energy.nbytes
+		return tracker.memoryUsage() + shared // len(group)
+
+	def reseed(self, tracker, roi, image):
+		# restart a tracker on a new target box, e.g. a detection overlapping it after it lost its target
+		self.remove(tracker)
+		tracker.resetConfidence()
+		tracker._vx = tracker._vy = 0.
+		return self.add(roi, image, tracker)
+
+	def update(self, image):
+		if self._group.trackers:
+			self._updateGroup(self._group, image)
+
+	def _updateGroup(self, group, image):
+		rows, cols = group.size
+		roi = np.array([t._roi for t in group.trackers], np.float64)  # (n, 4)
+		centre = roi[:, :2] + roi[:, 2:] / 2.
+		v = np.array([(t._vx, t._vy) for t in group.trackers], np.float64)  # (n, 2)
+		predicted = v.copy() if self.motion_model else np.zeros_like(v)  # v is updated in place below
+		roi[:, :2] += predicted
+		scale = self._windows(roi) / [cols, rows]  # (n, 2) image pixels per template pixel
+
+		roi[:, 0] = np.where(roi[:, 0] + roi[:, 2] <= 0, -roi[:, 2] + 1, roi[:, 0])
+		roi[:, 1] = np.where(roi[:, 1] + roi[:, 3] <= 0, -roi[:, 2] + 1, roi[:, 1])
+		roi[:, 0] = np.minimum(roi[:, 0], image.shape[1] - 2)
+		roi[:, 1] = np.minimum(roi[:, 1], image.shape[0] - 2)
+		cx = roi[:, 0] + roi[:, 2] / 2.
+		cy = roi[:, 1] + roi[:, 3] / 2.
+
+		# detect
+		n = len(group)
+		x = self._extract(group, image, roi)
+		xf = group.fft.forward(x, group.spectrumStack('xf', n))
+		k = self._correlation(group, xf, self._energy(group, 'x_energy', x), group.tmplf, group.tmpl_energy)
+		kf = group.fft.forward(k, group.spectrumStack('kf', n))
+		res = group.fft.inverse(group.fft.mul(group.alphaf, kf, group.spectrumStack('resf', n)), group.size,
+								group.stack('res', n))
+
+		# peak finding with sub-pixel refinement, for all targets at once
+		flat = res.reshape(n, -1).argmax(axis=1)
+		py, px = np.divmod(flat, cols)
+		idx = np.arange(n)
+		pv = res[idx, py, px]
+		left = res[idx, py, np.maximum(px - 1, 0)]
+		right = res[idx, py, np.minimum(px + 1, cols - 1)]
+		up = res[idx, np.maximum(py - 1, 0), px]
+		down = res[idx, np.minimum(py + 1, rows - 1), px]
+		locx = (px + np.where((px > 0) & (px < cols - 1), _subPixelPeak(left, pv, right), 0) - cols / 2.) * scale[:, 0]
+		locy = (py + np.where((py > 0) & (py < rows - 1), _subPixelPeak(up, pv, down), 0) - rows / 2.) * scale[:, 1]
+		psr = peakToSidelobe(res, py, px)
+
+		roi[:, 0] = cx - roi[:, 2] / 2.0 + locx
+		roi[:, 1] = cy - roi[:, 3] / 2.0 + locy
+		roi[:, 0] = np.minimum(roi[:, 0], image.shape[1] - 1)
+		roi[:, 1] = np.minimum(roi[:, 1], image.shape[0] - 1)
+		roi[:, 0] = np.where(roi[:, 0] + roi[:, 2] <= 0, -roi[:, 2] + 2, roi[:, 0])
+		roi[:, 1] = np.where(roi[:, 1] + roi[:, 3] <= 0, -roi[:, 3] + 2, roi[:, 1])
+		v += self.velocity_gain * (roi[:, :2] + roi[:, 2:] / 2. - centre - v)
+		limit = self.velocity_limit * roi[:, 2:] * [self.padding, 1.]  # the padded window of _windows
+		np.clip(v, -limit, limit, out=v)
+		movex = locx + predicted[:, 0]
+		movey = locy + predicted[:, 1]
+
+		# train on the new positions
+		self._train(group, self._extract(group, image, roi), self.interp_factor)
+
+		for i, t in enumerate(group.trackers):
+			if movex[i] < t.min_movement and movey[i] < t.min_movement:
+				t.not_moving_ctr += 1
+			else:
+				t.not_moving_ctr = 0
+			if t.not_moving_ctr > t.nonmoving_lifetime:
+				t.is_not_moving = True
+			t.updateConfidence(float(psr[i]))
+			if t.bad_tracking_ctr == 0:  # see KCFTracker.update
+				t._vx, t._vy = float(v[i, 0]), float(v[i, 1])
+			t._age += 1
+			t._dist += float(movex[i])  # only in x axis
+			t._roi = [int(v) for v in roi[i]]
+
+
+def _subPixelPeak(left, center, right):
+	# vectorized KCFTracker.subPixelPeak
+	divisor = 2 * center - right - left
+	safe = np.where(np.abs(divisor) < 1e-3, 1., divisor)
+	return np.where(np.abs(divisor) < 1e-3, 0, 0.5 * (right - left) / safe)
+
+
+# Process-pool tracker engine
+# Trackers are sharded over persistent worker processes, each one running its own KCFTrackerBank.
+# Every frame is copied once into a shared memory block that all workers map; only the commands
+# and the resulting ROIs/velocities travel through the pipes.
+def _poolWorker(conn, settings):
+	bank = KCFTrackerBank(settings=settings)
+	targets = {}  # tracker id -> KCFTracker
+	shm = None
+	while True:
+		msg = conn.recv()
+		if msg is None:
+			break
+		cmd = msg[0]
+		if cmd == 'frame':  # (cmd, shm name)
+			if shm is not None:
+				shm.close()
+			shm = shared_memory.SharedMemory(name=msg[1])
+			# the main process owns (and unlinks) the block, keep this worker's tracker off it
+			resource_tracker.unregister(shm._name, 'shared_memory')
+			continue
+		if cmd == 'remove':  # (cmd, tracker id)
+			bank.remove(targets.pop(msg[1]))
+			continue
+		if cmd == 'memory':  # (cmd,)
+			conn.send({tid: bank.memoryUsage(t) for tid, t in targets.items()})
+			continue
+
+		shape, dtype = msg[-2], msg[-1]
+		image = np.ndarray(shape, dtype, buffer=shm.buf)
+		if cmd == 'add':  # (cmd, tracker id, roi, shape, dtype)
+			t = targets[msg[1]] = bank.add(msg[2], image)
+			t.entrance_frame = None  # kept by the main process
+			conn.send(None)
+		elif cmd == 'reseed':  # (cmd, tracker id, roi, shape, dtype)
+			bank.reseed(targets[msg[1]], msg[2], image)
+			conn.send(None)
+		elif cmd == 'update':  # (cmd, shape, dtype)
+			bank.update(image)
+			conn.send([(tid, t._roi, t.getVelocity(), t._age, t.is_not_moving, t.psr, t.isTrackingBad(), t.isConfident())
+					   for tid, t in targets.items()])
+		del image
+	if shm is not None:
+		shm.close()
+	conn.close()
+
+
+class _PoolTarget:
+	__slots__ = ('tid', '_roi', '_age', '_velocity', 'is_not_moving', 'psr', 'is_tracking_bad', 'is_confident',
+				 'entrance_frame')
+
+	def __init__(self, tid, roi, entrance_frame):
+		self.tid = tid
+		self._roi = list(roi)
+		self._age = 0
+		self._velocity = 0.
+		self.is_not_moving = False
+		self.psr = 0.
+		self.is_tracking_bad = False
+		self.is_confident = True
+		self.entrance_frame = entrance_frame
+
+	def getPos(self):
+		return self._roi
+
+	def getAge(self):
+		return self._age
+
+	def getVelocity(self):
+		return self._velocity
+
+	def isNotMoving(self):
+		return self.is_not_moving
+
+	def isTrackingBad(self):
+		return self.is_tracking_bad
+
+	def isConfident(self):
+		return self.is_confident
+
 	def getEntranceFrame(self):
 		return self.entrance_frame
+
+
+class KCFTrackerPool:
+	def __init__(self, workers=None, settings=None):
+		settings = settings or config.load()
+		if workers is None:
+			workers = settings.tracker.pool_workers or max(1, mp.cpu_count() - 1)
+		self._conns = []
+		self._procs = []
+		for _ in range(workers):
+			parent_conn, child_conn = mp.Pipe()
+			proc = mp.Process(target=_poolWorker, args=(child_conn, settings), daemon=True)
+			proc.start()
+			child_conn.close()
+			self._conns.append(parent_conn)
+			self._procs.append(proc)
+		self._shards = [dict() for _ in range(workers)]  # per worker: tracker id -> _PoolTarget
+		self._worker_of = {}  # tracker id -> worker index
+		self._next_id = 0
+		self._shm = None
+		self.entrance_margin = settings.tracker.entrance_margin
+		self.entrance_size = settings.tracker.entrance_size
+
+	def __iter__(self):
+		return iter([t for shard in self._shards for t in shard.values()])
+
+	def __len__(self):
+		return len(self._worker_of)
+
+	def _publish(self, image):
+		# copy the frame into shared memory once, workers only get its shape and dtype
+		if self._shm is None or self._shm.size < image.nbytes:
+			if self._shm is not None:
+				self._shm.close()
+				self._shm.unlink()
+			self._shm = shared_memory.SharedMemory(create=True, size=image.nbytes)
+			for conn in self._conns:
+				conn.send(('frame', self._shm.name))
+		np.ndarray(image.shape, image.dtype, buffer=self._shm.buf)[...] = image
+
+	def add(self, roi, image):
+		# new trackers go to the least loaded worker
+		w = min(range(len(self._shards)), key=lambda i: len(self._shards[i]))
+		tid = self._next_id
+		self._next_id += 1
+		self._publish(image)
+		self._conns[w].send(('add', tid, [int(v) for v in roi], image.shape, image.dtype.str))
+		self._conns[w].recv()  # the worker copied the frame, it is safe to overwrite it
+		t = _PoolTarget(tid, roi, entranceSnapshot(image, roi, self.entrance_margin, self.entrance_size))
+		self._shards[w][tid] = t
+		self._worker_of[tid] = w
+		return t
+
+	def remove(self, tracker):
+		w = self._worker_of.pop(tracker.tid)
+		del self._shards[w][tracker.tid]
+		self._conns[w].send(('remove', tracker.tid))
+
+	def reseed(self, tracker, roi, image):
+		w = self._worker_of[tracker.tid]
+		self._publish(image)
+		self._conns[w].send(('reseed', tracker.tid, [int(v) for v in roi], image.shape, image.dtype.str))
+		self._conns[w].recv()
+		tracker._roi = list(roi)
+		tracker.psr = 0.
+		tracker.is_tracking_bad = False
+		tracker.is_confident = True
+		return tracker
+
+	def memoryUsage(self, tracker=None):
+		# bytes held by one tracker (in its worker, plus its entrance snapshot here), or by all of them
+		usage = {}
+		for conn in self._conns:
+			conn.send(('memory',))
+		for conn in self._conns:
+			usage.update(conn.recv())
+		for t in self:
+			usage[t.tid] += sys.getsizeof(t) + (t.entrance_frame.nbytes if t.entrance_frame is not None else 0)
+		return usage[tracker.tid] if tracker is not None else sum(usage.values())
+
+	def update(self, image):
+		busy = [w for w, shard in enumerate(self._shards) if shard]
+		if not busy:
+			return
+		self._publish(image)
+		for w in busy:
+			self._conns[w].send(('update', image.shape, image.dtype.str))
+		for w in busy:
+			shard = self._shards[w]
+			for tid, roi, velocity, age, not_moving, psr, tracking_bad, confident in self._conns[w].recv():
+				t = shard[tid]
+				t._roi = roi
+				t._velocity = velocity
+				t._age = age
+				t.is_not_moving = not_moving
+				t.psr = psr
+				t.is_tracking_bad = tracking_bad
+				t.is_confident = confident
+
+	def close(self):
+		for conn in self._conns:
+			conn.send(None)
+		for proc in self._procs:
+			proc.join()
+		if self._shm is not None:
+			self._shm.close()
+			self._shm.unlink()
+			self._shm = None
@@ -1,3 +1,5 @@
+import asyncio
+import heapq
 import threading
 import time
 import logging
@@ -5,15 +7,26 @@ import datetime
 import pyimgur
 import argparse
 from motion_detector import md
+import settings as config
+import executors
 import string
 import random
 import os
-from configparser import ConfigParser
 from AWSIoTPythonSDK.MQTTLib import AWSIoTMQTTClient
 from AWSIoTPythonSDK.exception.AWSIoTExceptions import publishTimeoutException
 
+# Runtime
+# The node runs on one asyncio event loop: the timers, the handling of the MQTT messages and of the motion
+# events, and the outbound publishing. The MQTT client threads and the vision pipeline only hand their
+# messages and events over to the loop (see threadsafe() and vision_event()), so network_devices and
+# network_motions are only ever touched by the loop thread. Blocking work runs off the loop: publishing
+# on the 'publish' executor (one worker, in order, bounded), and image uploads on the 'upload' executor.
+
 # Global Vars
 logger = None
+loop = None  # the event loop of the node
+control_pending = threading.Event()  # a control message waits in the 'publish' executor, see send_control()
+vision_queue = None  # (direction, speed, image_filename) of the motion events of the vision pipeline
 myMQTTClient = None
 control_timestamp = None
 device_id = None
@@ -23,10 +36,11 @@ cleanup_factor = None  # number of control_timer times
 deadline_factor = None
 network_devices = {}  # 'id': {'id': device_id, 'location': device_location, 'time': device_update_time}
 network_motions = {}  # 'motion_id': {'id': motion_id, 'direction': 'motion_direction', 'deadline': motion_deadline_time}
-send_control_lock = threading.Lock()
+motion_deadlines = []  # heap of (motion_deadline_time, motion_id) of network_motions, see expect_motion()
+alert_timer = None  # asyncio.TimerHandle of the earliest deadline of motion_deadlines
 config_filename = 'config.ini'
 imgur_client = None
-config_parser = None
+settings = None  # settings.Settings, shared with the motion detector
 
 
 def id_generator(size=6, chars=string.ascii_lowercase + string.digits):
@@ -48,7 +62,7 @@ def control_message_handler(client, userdata, message):
 	# Check if we need to send a control message or we just sent one
 	if control_timestamp is None or message_device_id not in network_devices or time.time() - control_timestamp > 10:  # can't resend messages faster
 		logger.debug('%s sending control to new device %s', device_id, message_device_id)
-		threading.Thread(target=send_control).start()
+		send_control()
 
 	# Update network devices
 	update_time = time.time()
@@ -80,7 +94,7 @@ def motion_message_handler(client, userdata, message):
 					   'time': time.time(),
 					   'direction': motion_direction,
 					   'deadline': motion_deadline}
-		network_motions[motion_id] = motion_info
+		expect_motion(motion_info)
 		logger.debug('%s recived motion from: %s id: %s direction: %s deadline: %s', device_id, message_device_id,
 					 motion_id, motion_direction,
 					 datetime.datetime.fromtimestamp(motion_deadline).strftime('%d/%m/%Y %H:%M:%S'))
@@ -125,8 +139,8 @@ def motion_detected(direction, speed, image_filename):
 		else:
 			motion_id = id_generator()
 		# Upload Img and Send motion event
-		if config_parser.getboolean('imgur', 'upload_img'):
-			threading.Thread(target=upload_image, args=[motion_id, image_filename]).start()
+		if settings.imgur.upload_img and image_filename is not None:
+			executors.named('upload', settings).submit(upload_image, motion_id, image_filename)
 
 		# Send motion message
 		send_motion(motion_id, direction, speed)
@@ -141,65 +155,114 @@ def cleanup_network_devices():
 			logger.debug('%s removed offline device %s', device_id, iter_device_id)
 
 
-def cleanup_network_thread_func():
+async def cleanup_network_task():
 	while True:
-		time.sleep(control_timer / 2)
+		await asyncio.sleep(control_timer / 2)
 		cleanup_network_devices()
+		logger.debug('%s executors: %s', device_id, executors.report())
 
 
-def send_control_thread_func():
-	global control_timestamp
+async def send_control_task():
+	# wakes up when the last control message gets control_timer old, not every second
 	while True:
-		time.sleep(1)
+		await asyncio.sleep(control_timestamp + control_timer - time.time())
 		if time.time() - control_timestamp >= control_timer:
-			logger.debug('%s sending control from send_control_thread', device_id)
-			threading.Thread(target=send_control).start()
+			logger.debug('%s sending control from send_control_task', device_id)
+			send_control()
+
+
+# Expected motions
+# A motion expected to reach us is alerted on at its deadline unless it is consumed before, by
+# motion_detected() or alert_message_handler(). The deadlines wait in a heap, and one loop timer fires at
+# the earliest: inserting is O(log n), and consuming a motion only removes it from network_motions, its
+# heap entry being skipped when it comes out (the entry of a motion received again is skipped the same way,
+# by its deadline).
+def expect_motion(motion_info):
+	network_motions[motion_info['id']] = motion_info
+	heapq.heappush(motion_deadlines, (motion_info['deadline'], motion_info['id']))
+	if motion_deadlines[0][1] == motion_info['id']:
+		schedule_alert_timer()
+
+
+def schedule_alert_timer():
+	global alert_timer
+	if alert_timer is not None:
+		alert_timer.cancel()
+		alert_timer = None
+	if motion_deadlines:
+		# deadlines are wall clock times, the loop timers run on the monotonic clock
+		alert_timer = loop.call_at(loop.time() + motion_deadlines[0][0] - time.time(), send_due_alerts)
+
+
+def send_due_alerts():
+	while motion_deadlines and motion_deadlines[0][0] <= time.time():
+		motion_deadline, motion_id = heapq.heappop(motion_deadlines)
+		motion = network_motions.get(motion_id)
+		if motion is None or motion['deadline'] != motion_deadline:
+			continue  # consumed, or received again with a later deadline
+		del network_motions[motion_id]
+		send_alert(motion_id)
+	schedule_alert_timer()
+
+
+async def vision_task():
+	while True:
+		direction, speed, image_filename = await vision_queue.get()
+		motion_detected(direction, speed, image_filename)
 
 
-def check_motion_thread_func():
-	while True:
-		time.sleep(1)
-		for iter_motion_id in list(network_motions):
-			motion = network_motions[iter_motion_id]
-			if motion['deadline'] < time.time():
-				send_alert(motion['id'])
-				del network_motions[motion['id']]
+def threadsafe(handler):
+	# an MQTT message handler that runs handler in the event loop, called by the MQTT client threads
+	def handle(client, userdata, message):
+		loop.call_soon_threadsafe(handler, client, userdata, message)
 
+	return handle
 
-def send_control():
-	global control_timestamp
-	send_control_lock.acquire()
-	control_timestamp = time.time()
+
+def vision_event(direction, speed, image_filename):
+	# the motion callback of the vision pipeline, called by its 'events' executor
+	loop.call_soon_threadsafe(vision_queue.put_nowait, (direction, speed, image_filename))
+
+
+def publish(topic, payload, dropped=None):
+	# queues a message on the 'publish' executor, from the event loop or any other thread; publish() blocks
+	# until the broker acknowledges (QoS 1), so its single worker sends the messages one at a time, in order
+	executors.named('publish', settings).submit(publish_blocking, topic, payload, dropped=dropped)
+
+
+def publish_blocking(topic, payload):
+	if topic == "control":
+		control_pending.clear()
 	try:
-		myMQTTClient.publish("control", "{},{}".format(device_id, get_location()), 1)
+		myMQTTClient.publish(topic, payload, 1)
 	except publishTimeoutException:
 		logger.error('%s got TIMEOUT', device_id)
-	send_control_lock.release()
+
+
+def send_control():
+	global control_timestamp
+	# a burst of new devices is answered by a single control message
+	if control_pending.is_set():
+		logger.debug('%s control already queued', device_id)
+		return
+	control_pending.set()
+	control_timestamp = time.time()
+	publish("control", "{},{}".format(device_id, get_location()), control_pending.clear)
 	logger.debug('%s sent control with location: %s', device_id, device_location)
 
 
 def send_motion(motion_id, motion_direction, motion_speed, img_url=None):
-	try:
-		myMQTTClient.publish("motion",
-							 "{},{},{},{},{}".format(device_id, motion_id, motion_direction, motion_speed, img_url), 1)
-	except publishTimeoutException:
-		logger.error('%s got TIMEOUT', device_id)
+	publish("motion", "{},{},{},{},{}".format(device_id, motion_id, motion_direction, motion_speed, img_url))
 	logger.debug('%s sent motion id: %s direction: %s speed: %s', device_id, motion_id, motion_direction, motion_speed)
 
 
 def send_alert(motion_id):
-	try:
-		myMQTTClient.publish("alert", "{},{}".format(device_id, motion_id), 1)
-	except publishTimeoutException:
-		logger.error('%s got TIMEOUT', device_id)
+	publish("alert", "{},{}".format(device_id, motion_id))
 	logger.debug('%s sent alert on motion_id: %s', device_id, motion_id)
 
 
 def send_image(motion_id, image_link):
-	try:
-		myMQTTClient.publish("image", "{},{},{}".format(device_id, motion_id, image_link), 1)
-	except publishTimeoutException:
-		logger.error('%s got TIMEOUT', device_id)
+	publish("image", "{},{},{}".format(device_id, motion_id, image_link))
 	logger.debug('%s sent image on motion_id: %s, link: %s', device_id, motion_id, image_link)
 
 
@@ -212,8 +275,8 @@ def mqtt_connect():
 	# For certificate based connection
 	myMQTTClient = AWSIoTMQTTClient(device_id)
 	# For TLS mutual authentication
-	endpoint_url = config_parser.get('mqtt', 'endpoint_url')
-	endpoint_port = int(config_parser.get('mqtt', 'endpoint_port'))
+	endpoint_url = settings.mqtt.endpoint_url
+	endpoint_port = settings.mqtt.endpoint_port
 	myMQTTClient.configureEndpoint(endpoint_url, endpoint_port)
 	myMQTTClient.configureCredentials("certs/root-CA.crt", "certs/{}.private.key".format(device_id),
 									  "certs/{}.cert.pem".format(device_id))
@@ -224,14 +287,14 @@ def mqtt_connect():
 	myMQTTClient.configureMQTTOperationTimeout(5)  # 5 sec
 
 	myMQTTClient.connect()  # Todo: try catch?
-	myMQTTClient.subscribe("control", 1, control_message_handler)
-	myMQTTClient.subscribe("motion", 1, motion_message_handler)
-	myMQTTClient.subscribe("alert", 1, alert_message_handler)
+	myMQTTClient.subscribe("control", 1, threadsafe(control_message_handler))
+	myMQTTClient.subscribe("motion", 1, threadsafe(motion_message_handler))
+	myMQTTClient.subscribe("alert", 1, threadsafe(alert_message_handler))
 
 
 def imgur_connect():
 	global imgur_client
-	imgur_client_id = config_parser.get('imgur', 'imgur_client_id')
+	imgur_client_id = settings.imgur.imgur_client_id
 	imgur_client = pyimgur.Imgur(imgur_client_id)
 
 
@@ -248,14 +311,13 @@ def get_motion_deadline(sender_device_id, motion_speed):
 
 
 def get_config():
-	global config_parser, device_id, device_location, control_timer, cleanup_factor, deadline_factor
-	config_parser = ConfigParser()
-	config_parser.read(config_filename)
-	device_id = config_parser.get('light', 'device_id')
-	device_location = config_parser.getint('light', 'device_location')
-	control_timer = config_parser.getint('light', 'control_timer')
-	cleanup_factor = config_parser.getfloat('light', 'cleanup_factor')
-	deadline_factor = config_parser.getfloat('light', 'deadline_factor')
+	global settings, device_id, device_location, control_timer, cleanup_factor, deadline_factor
+	settings = config.load(config_filename)
+	device_id = settings.light.device_id
+	device_location = settings.light.device_location
+	control_timer = settings.light.control_timer
+	cleanup_factor = settings.light.cleanup_factor
+	deadline_factor = settings.light.deadline_factor
 
 
 def get_logger():
@@ -283,12 +345,10 @@ def get_argparser_video():
 	return video_path, kill_time
 
 
-def main(video_path=None, kill_time=None):
-	# Get Config and General Parameters
-	get_config()
-
-	# Get Logger
-	get_logger()
+async def run(video_path=None, kill_time=None):
+	global loop, vision_queue
+	loop = asyncio.get_running_loop()
+	vision_queue = asyncio.Queue()
 
 	# Connect to Amazon's MQTT service
 	mqtt_connect()
@@ -301,25 +361,27 @@ def main(video_path=None, kill_time=None):
 	# Send Control Message
 	send_control()
 
-	# Create Cleanup Network thread
-	cleanup_network_devices_thread = threading.Thread(target=cleanup_network_thread_func)
-	cleanup_network_devices_thread.start()
-
-	# Create Control Message thread
-	control_message_thread = threading.Thread(target=send_control_thread_func)
-	control_message_thread.start()
-
-	# Create Check Motion thread
-	motion_check_thread = threading.Thread(target=check_motion_thread_func)
-	motion_check_thread.start()
+	# Cleanup Network, Control Message and motion events tasks
+	tasks = [asyncio.ensure_future(task()) for task in (cleanup_network_task, send_control_task, vision_task)]
 
 	# Create Image processing thread for Debug
-	if config_parser.getboolean('light', 'run_video') is True:
-		threading.Thread(target=md, args=[video_path, motion_detected]).start()
+	if settings.light.run_video is True:
+		threading.Thread(target=md, args=[video_path, vision_event, settings]).start()
 
 	if kill_time:
-		time.sleep(kill_time)
+		await asyncio.sleep(kill_time)
 		os._exit(1)
+	await asyncio.gather(*tasks)
+
+
+def main(video_path=None, kill_time=None):
+	# Get Config and General Parameters
+	get_config()
+
+	# Get Logger
+	get_logger()
+
+	asyncio.run(run(video_path, kill_time))
 
 
 if __name__ == '__main__':
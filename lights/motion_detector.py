@@ -7,67 +7,57 @@ import argparse
 import cv2
 import numpy as np
 import time
+import multiprocessing as mp
 import kcftracker
-import os
+import capture
+import pipeline
+import settings as config
+import snapshot
+import executors
 # import ip_configuration as IP
 from picamera.array import PiRGBArray
-import multiprocessing as mp
-import threading
 from picamera import PiCamera
-from configparser import ConfigParser
-
-# Globals
-config_filename = 'config.ini'
-config_parser = None
-do_resize = None
-
-
-def get_config():
-	global config_parser, do_resize, device_id
-	config_parser = ConfigParser()
-	config_parser.read(config_filename)
-	do_resize = config_parser.getboolean('tracker', 'resized')
-	device_id = config_parser.get('light', 'device_id')
-
-
-def overlap(box1, box2):
-	P1x = box1[0];
-	P1y = box1[1];
-	P2x = box1[0] + box1[2];
-	P2y = box1[1] + box1[3]
-	P3x = box2[0];
-	P3y = box2[1];
-	P4x = box2[0] + box2[2];
-	P4y = box2[1] + box2[3]
 
-	if not ((P2y < P3y) | (P1y > P4y) | (P2x < P3x) | (P1x > P4x)):
-		return True
-	return False
-
-
-def isNewObject(boundingbox, trackers):
-	# checks if an object, represented by bounding box, is already exists,
-	# by checking the overlap of it with all other tracked objects.
-
-	# for each tracker, check if it overlaps with the bounding box received as input
-	for t in trackers:
-		bbox = t.getPos()
-		if do_resize:
-			bbox = [bbox[0] * 2, bbox[1] * 2, bbox[2] * 2, bbox[3] * 2]
-		if overlap(map(int, bbox), map(int, boundingbox)):
-			return False
-	# if no tracker overlap with it, return True.
-	return True
-
-
-def isEdge(boundingbox, frameSize):
+def boxOverlaps(boxes1, boxes2):
+	# intersection over union of every (x, y, w, h) box of boxes1 with every box of boxes2, an (n, m) array
+	b1 = np.asarray(boxes1, np.float64).reshape(-1, 4)[:, None, :]
+	b2 = np.asarray(boxes2, np.float64).reshape(-1, 4)[None, :, :]
+	iw = np.minimum(b1[..., 0] + b1[..., 2], b2[..., 0] + b2[..., 2]) - np.maximum(b1[..., 0], b2[..., 0])
+	ih = np.minimum(b1[..., 1] + b1[..., 3], b2[..., 1] + b2[..., 3]) - np.maximum(b1[..., 1], b2[..., 1])
+	inter = np.maximum(iw, 0) * np.maximum(ih, 0)
+	union = b1[..., 2] * b1[..., 3] + b2[..., 2] * b2[..., 3] - inter
+	return inter / np.maximum(union, 1e-9)
+
+
+def greedyMatch(iou, threshold=0.):
+	# one-to-one (row, column) pairs of an overlap matrix, best overlap first, overlaps above threshold only
+	rows, cols = np.nonzero(iou > threshold)
+	order = np.argsort(-iou[rows, cols], kind='stable')
+	pairs = []
+	used_rows = set()
+	used_cols = set()
+	for r, c in zip(rows[order].tolist(), cols[order].tolist()):
+		if r not in used_rows and c not in used_cols:
+			used_rows.add(r)
+			used_cols.add(c)
+			pairs.append((r, c))
+	return pairs
+
+
+def trackerBoxes(trackers, resized):
+	# the full-frame (x, y, w, h) of the trackers, an (m, 4) array in their iteration order
+	# resized: the trackers run on the half-size frame
+	boxes = np.array([t.getPos() for t in trackers], np.float64).reshape(-1, 4)
+	return boxes * 2 if resized else boxes
+
+
+def isEdge(boundingbox, frameSize, margins_decision):
 	x = boundingbox[0];
 	y = boundingbox[1];
 	w = boundingbox[2];
 	h = boundingbox[3]
 	rows = frameSize[0];
 	cols = frameSize[1];
-	margins_decision = config_parser.getint('detection', 'margins_ignorance_decision')
 	if x <= margins_decision + 1:
 		return 'Left'
 	if (x + w) >= (cols - margins_decision + 1):
@@ -78,136 +68,277 @@ def isEdge(boundingbox, frameSize):
 	return None
 
 
-def cropRoi(image, roi):
-	rows = image.shape[0];
-	cols = image.shape[1];
-	x = roi[0];
-	y = roi[1];
-	w = roi[2];
-	h = roi[3]
-	to_x = min(x + w + 50, cols - 1)
-	to_y = min(y + h + 50, rows - 1)
-	x = max(0, x - 50)
-	y = max(0, y - 50)
-	return image[y:to_y, x:to_x]
-
-
-def worker(arg):
-	obj, frame = arg
-	return obj.update(frame)
-
-
-def md(path_to_video, cb):
-	get_config()
-	IMSHOW = config_parser.getboolean('debug', 'imshow')
-
+def extractBlobs(mask, detection, frame_width, scale=1, labels=None, offset=0):
+	# the (x, y, w, h) of the person-sized connected components of a binary mask, an (n, 4) array in full
+	# frame coordinates; scale: the full frame size over the mask size, labels: an int32 image of the mask
+	# size to reuse, offset: the column of the mask in the scaled frame
+	# all the components are filtered at once, so the cost hardly depends on how many there are
+	# the block based labelling of Grana et al. is the fastest one for the large, solid blobs of a closed mask
+	stats = cv2.connectedComponentsWithStatsWithAlgorithm(mask, 8, cv2.CV_32S, cv2.CCL_GRANA,
+														   labels=labels)[2][1:]  # no background
+	boxes = stats[:, :4] * scale
+	boxes[:, 0] += offset * scale
+	(x, w, h) = (boxes[:, 0], boxes[:, 2], boxes[:, 3])
+	margins = detection.margins_ignorance_detection
+	keep = ((stats[:, cv2.CC_STAT_AREA] * scale * scale >= detection.min_blob_area) &
+			(x >= margins) & (x + w <= frame_width - margins) &
+			(h >= detection.person_aspect_ratio * w))
+	return boxes[keep]
+
+
+class TrackingState:
+	# what the track stage tells the preprocess stage about the trackers, after every frame; shared
+	# between processes
+	def __init__(self):
+		self.live = mp.Value('i', 0)  # live trackers
+		# trackers lost, reseeded, started or removed for lack of detections, added up by the track stage until
+		# the preprocess stage runs a full frame detection: it runs frames ahead, so a one-frame signal must stay
+		self.unsettled = mp.Value('i', 0)
+		self.unconfident = mp.Value('i', 0)  # live trackers whose last detection was of low confidence
+
+
+class FrameItem:
+	# one frame and everything the pipeline stages derive from it
+	def __init__(self, frame, camera, scheduler):
+		self.frame = frame
+		self.start_time = time.time()
+		self.captured = camera.captured  # capture statistics at this frame
+		self.dropped = camera.dropped
+		self.missed = scheduler.missed  # pacing statistics at this frame
+		self.scheduled = scheduler.frames
+		self.keep = False  # carries a motion event, never shed (see pipeline.py)
+		self.event = None  # (direction, speed in m/sec)
+		self.event_roi = None  # full-frame [x, y, w, h] of the tracker that raised the event
+		self.tracker_boxes = []  # full-frame [x, y, w, h] of the trackers, for display
+		self.debug_images = {}  # name -> image, with debug on
+		self.blobs = np.empty((0, 4), np.int32)  # full-frame (x, y, w, h) of the person-sized foreground blobs
+		self.change = 0.  # fraction of the gate samples that differ from the background model
+		self.gated = False  # nothing changed and no tracker was alive: no detection and no tracking
+		self.gated_fraction = 0.  # of the frames so far
+		self.detection = None  # 'full', 'entry' (entry zones only), None (gated)
+		self.pre_time = self.md_time = self.trk_time = 0.
+
+
+class BufferPool:
+	# images allocated once per resolution and reused through the dst= arguments of OpenCV; get() returns
+	# None when disabled, and OpenCV allocates a new image as before
+	# an image handed to the next stages ('shared') comes from a ring of slots, one per frame, so it is
+	# not overwritten while a queued frame still refers to it
+	def __init__(self, enabled=True, slots=1):
+		self.enabled = enabled
+		self.slots = slots
+		self._buffers = {}
+		self._frame = 0
+
+	def nextFrame(self):
+		self._frame += 1
+
+	def get(self, name, shape, dtype=np.uint8, shared=False):
+		if not self.enabled:
+			return None
+		key = (name, self._frame % self.slots if shared else 0)
+		buf = self._buffers.get(key)
+		if buf is None or buf.shape != shape or buf.dtype != dtype:
+			buf = self._buffers[key] = np.empty(shape, dtype)
+		return buf
+
+
+class Preprocessor:
 	################################################################################################################
-	### 0) Initializtion
+	### 2) Pre-Processing, and the foreground blobs of motion detection (they do not depend on the trackers)
 	################################################################################################################
-
-	alpha = config_parser.get('detection', 'alpha_blending')
-	trackers = []
-	model = None
-	hh = config_parser.getint('detection', 'closing_kernel_height')
-	ww = config_parser.getint('detection', 'closing_kernel_width')
-	sub_sampling = config_parser.getint('motion', 'sub_sampling')
-	kernel = np.ones((ww, hh), np.uint8)
-	flagRight = flagLeft = False
-	max_time = -1
-
-	cv2.namedWindow("Image")
-
-	# if the video argument is None, then we are reading from webcam
-	if path_to_video is None:
-		camera = cv2.VideoCapture(0)
-		#    camera = PiCamera()
-		#    camera.resolution = (640, 480)
-		#    camera.framerate = 32
-		#    rawCapture = PiRGBArray(camera, size=(640, 480))
-		time.sleep(0.25)
-
-	# otherwise, we are reading from a video file
-	else:
-		camera = cv2.VideoCapture(path_to_video)
-
-	# loop over the frames of the video
-	#  for frame_raw in camera.capture_continuous(rawCapture, format="bgr", use_video_port=True):
-	while True:
-		start_time = time.time()
-
-		################################################################################################################
-		### 1) Grab a frame
-		################################################################################################################
-
-		# grab the current frame
-
-		for repeat in range(1, sub_sampling - 1):
-			camera.read()
-
-		(grabbed, frame) = camera.read()
-		# if the frame could not be grabbed, then we have reached the end of the video
-		if not grabbed:
-			break
-
-		# frame = frame_raw.array
-
-		################################################################################################################
-		### 2) Pre-Processing
-		################################################################################################################
+	def __init__(self, settings, state=None):
+		# state: the TrackingState of the track stage; the gate never skips a frame while a tracker is live,
+		# and detection leaves the middle of the frame to the trackers only while they are all settled and
+		# confident
+		self.detection = settings.detection
+		self.debug = settings.debug.debug
+		self.state = state
+		self.gate_step = self.detection.gate_step
+		self.gate_model = None
+		self.frames = 0
+		self.gated = 0
+		self.resized = settings.tracker.resized
+		# motion detection runs on level detection_level of a pyramid of the gray frame, each level half the
+		# size of the previous one; the trackers run on level 1 when resized, on level 0 otherwise
+		self.level = self.detection.detection_level
+		self.levels = max(self.level, 1 if self.resized else 0) + 1
+		self.scale = 2 ** self.level
+		# the sizes of the detection parameters at the detection level
+		self.gaussian_width = max(1, self.detection.gaussian_width >> self.level) | 1
+		self.kernel = np.ones((max(1, self.detection.closing_kernel_width // self.scale),
+							   max(1, self.detection.closing_kernel_height // self.scale)), np.uint8)
+		self.model = None
+		# detection cadence: the whole frame every detection_interval frames, the entry zones at the left
+		# and right margins (where new objects appear) in between
+		self.detection_interval = self.detection.detection_interval
+		self.entry_zone = self.detection.entry_zone // self.scale
+		self.since_full = 0  # frames since the last full frame detection
+		self.full_change = 0.  # change score of the last full frame detection
+		# a frame is referred to by at most queue_size frames waiting for tracking and for display, plus
+		# the ones being tracked and displayed
+		self.buffers = BufferPool(settings.pipeline.buffer_pool, 2 * settings.pipeline.queue_size + 3)
+
+	def __call__(self, item):
+		detection = self.detection
+		buffers = self.buffers
+		buffers.nextFrame()
 		pre_start_time = time.time()
-		# resize the frame, convert it to grayscale, and blur it
+		(h, w) = item.frame.shape[:2]
+
+		# gate: an idle scene costs one sparse sample of the frame and its difference from the same sample
+		# of the background model
+		if self.gate_step:
+			(gh, gw) = (h // self.gate_step, w // self.gate_step)
+			sample = cv2.resize(item.frame, (gw, gh), interpolation=cv2.INTER_NEAREST,
+								dst=buffers.get('gate_frame', (gh, gw, 3)))
+			sample = cv2.cvtColor(sample, cv2.COLOR_BGR2GRAY, dst=buffers.get('gate', (gh, gw)))
+			if self.gate_model is None:
+				self.gate_model = sample.copy()
+			else:
+				diff = cv2.absdiff(self.gate_model, sample, dst=buffers.get('gate_diff', (gh, gw)))
+				item.change = np.count_nonzero(diff > detection.absdiff_threshold) / float(diff.size)
+				self.frames += 1
+				if item.change <= detection.gate_threshold and not (self.state is not None and self.state.live.value):
+					self.gated += 1
+					item.gated = True
+				item.gated_fraction = self.gated / float(self.frames)
+				if item.gated:
+					item.pre_time = time.time() - pre_start_time
+					return item
 
-		gray_frame = cv2.cvtColor(frame, cv2.COLOR_BGR2GRAY)
+		# resize the frame, convert it to grayscale, and blur it
+		item.gray_frame = cv2.cvtColor(item.frame, cv2.COLOR_BGR2GRAY, dst=buffers.get('gray_frame', (h, w), shared=True))
+		pyramid = [item.gray_frame]
+		for level in range(1, self.levels):
+			(lh, lw) = pyramid[-1].shape
+			pyramid.append(cv2.resize(pyramid[-1], None, fx=0.5, fy=0.5, interpolation=cv2.INTER_LINEAR,
+									  dst=buffers.get('level{}'.format(level), (int(np.rint(lh * 0.5)), int(np.rint(lw * 0.5))),
+													  shared=True)))
+		item.frame_resized = pyramid[1] if self.resized else None
+
+		detection_frame = pyramid[self.level]
+		# if the first frame is None, initialize it
+		if self.model is None:
+			gw = self.gaussian_width
+			self.model = cv2.GaussianBlur(detection_frame, (gw, gw), 0)
+			self.full_change = item.change
+			return None
+		item.pre_time = time.time() - pre_start_time
 
-		if do_resize:
-			frame_resized = cv2.resize(gray_frame, None, fx=0.5, fy=0.5, interpolation=cv2.INTER_LINEAR)
+		md_start_time = time.time()
+		w = detection_frame.shape[1]
+		zone = min(self.entry_zone, w // 2)
+		unsettled = self.state.unsettled.value if self.state is not None else 0
+		if self.isFullDetectionDue(item, unsettled):
+			self.since_full = 0
+			self.full_change = item.change
+			item.detection = 'full'
+			item.blobs = self.detect(detection_frame, 0, w, item)
+			if unsettled:
+				with self.state.unsettled.get_lock():
+					self.state.unsettled.value -= unsettled  # the signals this detection answered, not newer ones
+		else:
+			# blobs cut by the inner edge of a zone are left to the trackers and to the next full detection
+			self.since_full += 1
+			item.detection = 'entry'
+			left = self.detect(detection_frame, 0, zone, item)
+			right = self.detect(detection_frame, w - zone, w, item)
+			item.blobs = np.concatenate((left[left[:, 0] + left[:, 2] < zone * self.scale],
+										 right[right[:, 0] > (w - zone) * self.scale]))
+		item.md_time = time.time() - md_start_time
+		return item
+
+	def isFullDetectionDue(self, item, unsettled):
+		if self.detection_interval <= 1 or self.since_full + 1 >= self.detection_interval:
+			return True
+		# back to detection on every frame as soon as a track is lost, started or unsure, or the scene changed
+		if self.state is None or not self.state.live.value or unsettled or self.state.unconfident.value:
+			return True
+		return item.change - self.full_change > self.detection.cadence_change
+
+	def detect(self, image, x0, x1, item):
+		# the person-sized foreground blobs of columns x0:x1 of the detection level, in full frame coordinates
+		detection = self.detection
+		buffers = self.buffers
+		full = x1 - x0 == image.shape[1]
+		tag = 'full' if full else '{}:{}'.format(x0, x1)
+		shared = self.debug and full
+		image = image[:, x0:x1]
+		(h, w) = image.shape
+		gw = self.gaussian_width
+		gray = cv2.GaussianBlur(image, (gw, gw), 0, dst=buffers.get(tag + 'gray', (h, w), shared=shared))
+		# compute the absolute difference between the current frame and first frame
+		frameDelta = cv2.absdiff(self.model[:, x0:x1], gray,
+								 dst=buffers.get(tag + 'frameDelta', (h, w), shared=shared))
+		thresh1 = cv2.threshold(frameDelta, detection.absdiff_threshold, 255, cv2.THRESH_BINARY,
+								dst=buffers.get(tag + 'thresh1', (h, w), shared=shared))[1]
+		thresh2 = cv2.morphologyEx(thresh1, cv2.MORPH_CLOSE, self.kernel,
+								   dst=buffers.get(tag + 'thresh2', (h, w), shared=shared))
+		if shared:
+			item.debug_images = {"Thresh": thresh1, "Blobs": thresh2, "Frame Delta": frameDelta, "Model": self.model,
+								 "Gray": gray}
+		return extractBlobs(thresh2, detection, item.frame.shape[1], self.scale,
+							buffers.get(tag + 'labels', (h, w), np.int32), x0)
+
+
+class TrackAssociate:
+	################################################################################################################
+	### 3) - 5) Tracking, boundary crossing and the assignment of the detected blobs to trackers
+	################################################################################################################
+	def __init__(self, settings, state=None):
+		# state: a TrackingState, updated after every frame for the gate and the detection cadence of
+		# Preprocessor
+		self.settings = settings
+		self.state = state
+		self.resized = settings.tracker.resized
+		# what to do with a tracker that lost its target (see KCFTracker.isTrackingBad):
+		# retire - remove it right away, reseed - restart it on an overlapping detection, else remove it
+		self.bad_tracking_policy = settings.tracker.bad_tracking_policy
+		# a detection overlapping a tracker by more than association_iou supports it; trackers no detection
+		# supported for unsupported_lifetime frames in a row are removed (0: never)
+		self.association_iou = settings.detection.association_iou
+		self.unsupported_lifetime = settings.detection.unsupported_lifetime
+		self.unsupported = {}  # tracker -> frames in a row without a supporting detection
+		self.trackers = None  # created by the first frame, in the worker of this stage
+
+	def __call__(self, item):
+		settings = self.settings
+		motion = settings.motion
+		if self.trackers is None:
+			if settings.tracker.engine == 'pool':
+				self.trackers = kcftracker.KCFTrackerPool(settings=settings)
+			else:
+				self.trackers = kcftracker.KCFTrackerBank(settings=settings)
+		trackers = self.trackers
+		if item.gated:
+			# a tracker started on a frame still queued when this one was gated just waits for the next one
+			return item
 
-		gw = config_parser.getint('detection', 'gaussian_width')
-		gray = cv2.GaussianBlur(gray_frame, (gw, gw), 0)
-		frame2show = frame.copy()
-		# if the first frame is None, initialize it
-		if model is None:
-			model = gray
-			continue
-		pre_end_time = time.time()
-		pre_time = pre_end_time - pre_start_time
-		################################################################################################################
+		############################################################################################################
 		### 3) Track existing trackers, and update them
-		################################################################################################################
+		############################################################################################################
 		flagLeft = False
 		flagRight = False
-		right_roi = None
-		left_roi = None
 
 		trk_start_time = time.time()
 
-		# Trackers_bboxes = map(lambda x: x.update(gray_frame), trackers)
-		threads = []
-		if do_resize:
-			tracker_frame = frame_resized
+		if self.resized:
+			tracker_frame = item.frame_resized
 		else:
-			tracker_frame = gray_frame
-
-		for t in trackers:
-			thread = threading.Thread(target=t.update, args=([tracker_frame]))
-			threads.append(thread)
-			thread.start()
-
-		for t in threads:
-			t.join()
-
-		trk_end_time = time.time()
-		trk_time = trk_end_time - trk_start_time
-
-		# for t in trackers:
-		#    boundingbox = t.update(gray_frame)
-		# boundingbox = map(int, boundingbox)
-
-		# if t.isTrackingBad() is True:
-		#     trackers.remove(t)
+			tracker_frame = item.gray_frame
 
+		# all trackers are updated together in one batched pass
+		trackers.update(tracker_frame)
 
+		item.trk_time = time.time() - trk_start_time
 
+		# trackers that lost their target stop costing a tracker update from the next frame on
+		lost = [t for t in trackers if t.isTrackingBad()]
+		if self.bad_tracking_policy == 'retire':
+			for t in lost:
+				trackers.remove(t)
+		unsettled = len(lost)
 
 		############################################################################################################
 		### 4) Check for trackers that cross image boundries
@@ -221,148 +352,270 @@ def md(path_to_video, cb):
 				trackers.remove(t)
 				continue
 
+			if t.isTrackingBad():  # waiting for a detection to reseed it, its position is not reliable
+				continue
+
 			boundingbox = t.getPos()
-			if do_resize:
+			if self.resized:
 				boundingbox = [boundingbox[0] * 2, boundingbox[1] * 2, boundingbox[2] * 2, boundingbox[3] * 2]
-			edge = isEdge(boundingbox, [gray_frame.shape[0], gray_frame.shape[1]])
+			edge = isEdge(boundingbox, [item.gray_frame.shape[0], item.gray_frame.shape[1]],
+						  settings.detection.margins_ignorance_decision)
 			if edge is not None:
-				if edge is 'Right':
+				item.event_roi = boundingbox
+				if edge == 'Right':
 					flagRight = True
-					right_roi = boundingbox
-				if edge is 'Left':
+				if edge == 'Left':
 					flagLeft = True
-					left_roi = boundingbox
 				speed = t.getVelocity()  # in pixels per frame!!
 
-				delta_alpha = speed / config_parser.getint('motion', 'image_width') * config_parser.getfloat('motion',
-																											 'camera_fov')
-				speedMetersPerFrame = config_parser.getfloat('motion', 'camera_distance') * np.tan(
-					np.radians(2 * delta_alpha))
-				speedMeterPerSecond = speedMetersPerFrame * config_parser.getfloat('motion', 'frames_per_sec')
+				delta_alpha = speed / motion.image_width * motion.camera_fov
+				speedMetersPerFrame = motion.camera_distance * np.tan(np.radians(2 * delta_alpha))
+				speedMeterPerSecond = speedMetersPerFrame * motion.frames_per_sec
 
 				# print "speed is : {}".format(speed)
 
 				trackers.remove(t)
 
-			if IMSHOW:
-				cv2.rectangle(frame2show, (boundingbox[0], boundingbox[1]),
-							  (boundingbox[0] + boundingbox[2], boundingbox[1] + boundingbox[3]), (0, 255, 255), 2)
+			item.tracker_boxes.append(boundingbox)
 
 			# TODO: if object is not moving much, remove it.
 
-		################################################################################################################
+		############################################################################################################
 		### 5) Motion Detection assignment
-		################################################################################################################
+		############################################################################################################
 		md_start_time = time.time()
 
-		# compute the absolute difference between the current frame and first frame
-		frameDelta = cv2.absdiff(model, gray)
-		th = config_parser.getint('detection', 'absdiff_threshold')
-		thresh1 = cv2.threshold(frameDelta, th, 255, cv2.THRESH_BINARY)[1]
-		thresh2 = cv2.morphologyEx(thresh1, cv2.MORPH_CLOSE, kernel, 2)
-		(_, cnts, _) = cv2.findContours(thresh2.copy(), cv2.RETR_EXTERNAL, cv2.CHAIN_APPROX_SIMPLE)
-
-		# loop over the contours
-		for c in cnts:
-
-			# if the contour is too small, ignore it
-			if cv2.contourArea(c) < config_parser.getint('detection', 'min_blob_area'):
-				continue
+		# overlaps of all detections with all trackers, then one-to-one assignment
+		tracked = list(trackers)
+		iou = boxOverlaps(item.blobs, trackerBoxes(tracked, self.resized))
+		blobs = item.blobs.tolist()
+		# if a new object detect, start tracking on it, once for overlapping new detections
+		new = item.blobs[~(iou > self.association_iou).any(axis=1)]
+		first = ~np.tril(boxOverlaps(new, new) > self.association_iou, -1).any(axis=1)
+		new = new[first].tolist()
+		# a lost tracker restarts on the detection assigned to it
+		supported = set()
+		for i, j in greedyMatch(iou, self.association_iou):
+			t = tracked[j]
+			supported.add(t)
+			if t.isTrackingBad():
+				unsettled += 1
+				(x, y, w, h) = blobs[i]
+				if self.resized:
+					trackers.reseed(t, [int(x / 2), int(y / 2), int(w / 2), int(h / 2)], item.frame_resized)
+				else:
+					trackers.reseed(t, [x, y, w, h], item.frame)
 
-			# compute the bounding box for the contour, draw it on the frame,
-			# and update the text
-			(x, y, w, h) = cv2.boundingRect(c)
-			margins_detection = config_parser.getint('detection', 'margins_ignorance_detection')
-			if x < margins_detection or (x + w) > (frame.shape[1] - margins_detection):
-				continue
-			aspect_ratio = float(h) / w
-			if aspect_ratio < config_parser.getfloat('detection', 'person_aspect_ratio'):
+		# lost trackers that no detection could reseed, and trackers no detection supports any more (only
+		# a full frame detection can tell)
+		unsupported = {}
+		for t in tracked:
+			if t.isTrackingBad():
+				trackers.remove(t)
 				continue
-			if IMSHOW:
-				cv2.rectangle(frame2show, (x, y), (x + w, y + h), (0, 255, 0), 2)
-
-			# if a new object detect, start tracking on it
-			if isNewObject([x, y, w, h], trackers):
-				new_tracker = kcftracker.KCFTracker(False, False, False)
-				if do_resize:
-					new_tracker.init(map(int, [x / 2, y / 2, w / 2, h / 2]), frame_resized)
-				else:
-					new_tracker.init([x, y, w, h], frame)
-				trackers.append(new_tracker)
-				trackerInit = True
+			unsupported[t] = 0 if t in supported else self.unsupported.get(t, 0) + (item.detection == 'full')
+			if self.unsupported_lifetime and unsupported[t] >= self.unsupported_lifetime:
+				trackers.remove(t)
+				del unsupported[t]
+				unsettled += 1
+		self.unsupported = unsupported
+
+		for (x, y, w, h) in new:
+			if self.resized:
+				trackers.add([int(x / 2), int(y / 2), int(w / 2), int(h / 2)], item.frame_resized)
+			else:
+				trackers.add([x, y, w, h], item.frame)
+
+		item.md_time += time.time() - md_start_time
+		if self.state is not None:
+			self.state.live.value = len(trackers)
+			self.state.unconfident.value = sum(not t.isConfident() for t in trackers)
+			if unsettled + len(new):
+				with self.state.unsettled.get_lock():
+					self.state.unsettled.value += unsettled + len(new)
 
-		# TODO: if certain tracker doesn't overlap with any other detection, at least 10 frames, erase it.
+		if flagLeft or flagRight:
+			direction = 'Right' if flagRight else 'Left'
+			item.event = (direction, float('{:.3f}'.format(speedMeterPerSecond)))
+			item.keep = True
+		return item
 
+	def close(self):
+		if isinstance(self.trackers, kcftracker.KCFTrackerPool):
+			self.trackers.close()
 
 
-		# model = cv2.addWeighted(model, 1 - alpha, gray, alpha, 0)
-		md_end_time = time.time()
-		md_time = md_end_time - md_start_time
-		################################################################################################################
-		### 6) Display
-		################################################################################################################
-		SAVE_EVENTS = config_parser.get('motion', 'save_events')
+class Emitter:
+	################################################################################################################
+	### 6) Display, and the motion events
+	################################################################################################################
+	def __init__(self, settings, cb):
+		self.settings = settings
+		self.cb = cb
+		# headless: no window, no annotation and no keys
+		self.headless = settings.debug.headless
+		self.started = False
+		self.snapshots = None  # created by the first frame, writes the event snapshots in the background
+		self.events = None  # the 'events' executor, runs cb
+		self._frame2show = None  # the annotated frame, reused
+		self._last = None  # the last frame, for its statistics
+
+	def __call__(self, item):
+		debug = self.settings.debug
+		IMSHOW = debug.imshow and not self.headless
+		if not self.started:
+			self.started = True
+			if not self.headless:
+				cv2.namedWindow("Image")
+			self.events = executors.named('events', self.settings)
+			if self.settings.motion.save_events:
+				cfg = self.settings.snapshot
+				self.snapshots = snapshot.SnapshotWriter(cfg.directory, cfg.workers, cfg.queue_size, cfg.crop,
+														 cfg.max_width, cfg.jpeg_quality)
+
+		# the frame is annotated only for display; otherwise it is shown and saved as captured
+		frame2show = item.frame
+		if IMSHOW:
+			if self._frame2show is None or self._frame2show.shape != item.frame.shape:
+				self._frame2show = np.empty_like(item.frame)
+			frame2show = self._frame2show
+			np.copyto(frame2show, item.frame)
+			for boundingbox in item.tracker_boxes:
+				cv2.rectangle(frame2show, (boundingbox[0], boundingbox[1]),
+							  (boundingbox[0] + boundingbox[2], boundingbox[1] + boundingbox[3]), (0, 255, 255), 2)
+			for (x, y, w, h) in item.blobs.tolist():
+				cv2.rectangle(frame2show, (x, y), (x + w, y + h), (0, 255, 0), 2)
 
-		if flagLeft or flagRight:
-			image_filename_path = None
+		if item.event is not None:
+			direction, speedMeterPerSecond = item.event
 			if IMSHOW:
 				cv2.putText(frame2show, "Motion Right, speed: {:.3f} m/sec".format(speedMeterPerSecond), (10, 200),
 							cv2.FONT_HERSHEY_SIMPLEX, 0.5, (0, 0, 255), 1)
 
-			if flagLeft:
-				direction = 'Left'
-
-			if flagRight:
-				direction = 'Right'
-
-			if SAVE_EVENTS:
-				image_filename = time.strftime("%Y%m%d-%H%M%S")
-				image_filename_path = os.path.join('images', image_filename + '-{}.jpg'.format(direction))
-				cv2.imwrite(image_filename_path, frame2show)
-
-			speedMeterPerSecond = float('{:.3f}'.format(speedMeterPerSecond))
-			threading.Thread(target=cb, args=[direction, speedMeterPerSecond, image_filename_path]).start()
+			# the event goes out once its snapshot is written, or right away without one
+			def done(image_filename_path, direction=direction, speedMeterPerSecond=speedMeterPerSecond):
+				if self.cb is not None:
+					self.events.submit(self.cb, direction, speedMeterPerSecond, image_filename_path)
+
+			if self.snapshots is not None:
+				image_filename = time.strftime("%Y%m%d-%H%M%S") + '-{}'.format(direction)
+				# the annotated frame is reused for the next frame, the captured one is not
+				image = frame2show.copy() if frame2show is self._frame2show else frame2show
+				self.snapshots.submit(image, item.event_roi, image_filename, done)
+			else:
+				done(None)
+
+		if not self.headless:
+			# show the frame
+			if IMSHOW:
+				cv2.putText(frame2show, "ID: {} ".format(self.settings.light.device_id), (5, 15),
+							cv2.FONT_HERSHEY_SIMPLEX, 0.5, (255, 0, 0), 2)
+			cv2.imshow("Image", frame2show)
+			if debug.debug:
+				for name, image in item.debug_images.items():
+					cv2.imshow(name, image)
 
 		algo_end_time = time.time()
-		algo_time = algo_end_time - start_time
+		algo_time = algo_end_time - item.start_time
+
+		# the frames are paced when fed to the pipeline (see md()), the window only has to be refreshed
+		if not self.headless:
+			# record if the user presses a key
+			key = cv2.waitKey(1) & 0xFF
+
+			# if the `q` key is pressed, stop the pipeline
+			if key == ord("q"):
+				raise pipeline.StopPipeline()
+
+		debug_time = time.time() - item.start_time
+
+		if debug.print_time:
+			print("--- total: {:.4f}: algo({:.4f}), pre({:.3f}), md({:.3f}), trk({:.3f}), dropped({}/{}), "
+				  "gated({}, {:.1%}), detection({}), missed({}/{})".format(
+				debug_time, algo_time, item.pre_time, item.md_time, item.trk_time, item.dropped, item.captured,
+				item.gated, item.gated_fraction, item.detection, item.missed, item.scheduled))
+		self._last = item
+		return None
+
+	def close(self):
+		if not self.headless:
+			cv2.destroyAllWindows()
+		if self.snapshots is not None:
+			self.snapshots.close()
+		if self.settings.debug.print_time and self._last is not None:
+			print("--- gated: {:.1%} of the frames, missed deadlines: {} of {} frames".format(
+				self._last.gated_fraction, self._last.missed, self._last.scheduled))
+			if self.snapshots is not None:
+				print("--- snapshots: {} written, {} dropped".format(self.snapshots.written, self.snapshots.dropped))
+			print("--- executors: {}".format(executors.report()))
+
+
+def md(path_to_video, cb, settings=None):
+	# settings: a settings.Settings, config.ini by default; read once, the stages only read attributes
+	#
+	# the frames stream through a pipeline (see pipeline.py) whose stages overlap:
+	#   capture -> preprocess (+ foreground blobs) -> track and associate -> emit (display, events)
+	# every stage runs in a thread, a process or inline, as set in the [pipeline] section
+	settings = settings or config.load()
+	sub_sampling = settings.motion.sub_sampling
+	cfg = settings.pipeline
 
-		time_to_wait = 166 - int(algo_time * 1000)
-		if time_to_wait <= 0:
-			time_to_wait = 1
-		# print time_to_wait
-
-		# show the frame and record if the user presses a key
-		if IMSHOW:
-			cv2.putText(frame2show, "ID: {} ".format(device_id), (5, 15), cv2.FONT_HERSHEY_SIMPLEX, 0.5,
-						(255, 0, 0), 2)
-		cv2.imshow("Image", frame2show)
-		if config_parser.getboolean('debug', 'debug'):
-			cv2.imshow("Thresh", thresh1)
-			cv2.imshow("Blobs", thresh2)
-			cv2.imshow("Frame Delta", frameDelta)
-			cv2.imshow("Model", model)
-			cv2.imshow("Gray", gray)
-
-		key = cv2.waitKey(time_to_wait) & 0xFF
-
-		# if the `q` key is pressed, break from the lop
-		if key == ord("q"):
-			break
-
-		debug_end_time = time.time()
-		debug_time = debug_end_time - start_time
+	################################################################################################################
+	### 0) Initializtion
+	################################################################################################################
 
-		if config_parser.getboolean('debug', 'print_time'):
-			print("--- total: {:.4f}: algo({:.4f}), pre({:.3f}), md({:.3f}), trk({:.3f})".format(debug_time, algo_time,
-																								 pre_time, md_time,
-																								 trk_time))
+	# frames are captured in their own thread; sub_sampling - 2 frames are skipped (grabbed, not decoded)
+	# before every processed one
+	# if the video argument is None, then we are reading from webcam, and a frame that was not
+	# processed in time is replaced by a newer one
+	if path_to_video is None:
+		camera = capture.FrameCapture(0, max(0, sub_sampling - 2), drop=True)
+		#    camera = PiCamera()
+		#    camera.resolution = (640, 480)
+		#    camera.framerate = 32
+		#    rawCapture = PiRGBArray(camera, size=(640, 480))
+		time.sleep(0.25)
 
-		# rawCapture.truncate(0)
+	# otherwise, we are reading from a video file, and every kept frame is processed
+	else:
+		camera = capture.FrameCapture(path_to_video, max(0, sub_sampling - 2), drop=False)
+	camera.start()
+
+	shedding = cfg.shedding
+	if shedding == 'auto':
+		shedding = 'drop_oldest' if path_to_video is None else 'block'
+	state = TrackingState()
+	stages = pipeline.Pipeline([pipeline.Stage('preprocess', Preprocessor(settings, state), cfg.preprocess),
+								pipeline.Stage('track', TrackAssociate(settings, state), cfg.track),
+								pipeline.Stage('emit', Emitter(settings, cb), cfg.emit)],
+							   cfg.queue_size, shedding)
 
-	# cleanup the camera and close any open windows
+	################################################################################################################
+	### 1) Grab a frame
+	################################################################################################################
+	# one frame per 1 / frames_per_sec enters the pipeline, so the trackers are updated at frames_per_sec, the
+	# rate their speeds are converted with; stages slower than that shed or wait
+	scheduler = pipeline.FrameScheduler(settings.motion.frames_per_sec)
+
+	def frames():
+		#  for frame_raw in camera.capture_continuous(rawCapture, format="bgr", use_video_port=True):
+		while True:
+			# grab the newest frame
+			(grabbed, frame) = camera.read()
+			# if the frame could not be grabbed, then we have reached the end of the video
+			if not grabbed:
+				return
+			yield FrameItem(frame, camera, scheduler)
+			time.sleep(scheduler.next())
+			# rawCapture.truncate(0)
+
+	stages.run(frames())
+
+	# cleanup the camera
 	camera.release()
-	cv2.destroyAllWindows()
-
+	if settings.debug.print_time:
+		print("--- frames: {} captured, {} dropped by capture, {} shed by the pipeline".format(
+			camera.captured, camera.dropped, stages.stats['dropped']))
 
 if __name__ == '__main__':
 	ap = argparse.ArgumentParser()
@@ -0,0 +1,170 @@
+import queue
+import threading
+import time
+import traceback
+import multiprocessing as mp
+
+# Streaming pipeline
+# A chain of stages connected by bounded queues. Every stage is a callable taking one item and
+# returning the item for the next stage (or None to drop it); it runs in its own thread, in its own
+# process, or inline, right after the previous stage in that stage's worker. Stages that keep state
+# (a background model, trackers) see their items in order, and process stages keep their state in
+# the child process (the callable is pickled once, when the pipeline starts).
+#
+# Load shedding: when a stage falls behind, its input queue fills up and the stage before it either
+#   block        waits for room (every item is processed, e.g. a video file)
+#   drop_oldest  drops the oldest queued item, so the freshest data goes through (e.g. a live camera)
+#   drop_newest  drops the item it tried to put
+# Items with a true 'keep' attribute (e.g. carrying a motion event) are never dropped: when the oldest
+# queued item is one, the new item is dropped instead, and the queue keeps its order. A queue between
+# processes cannot be looked into, so drop_oldest drops the new item there.
+
+MODES = ('thread', 'process', 'inline')
+SHEDDING = ('block', 'drop_oldest', 'drop_newest')
+
+_STOP = None  # end of stream marker, travels through every queue
+
+
+class StopPipeline(Exception):
+	# raised by a stage to stop the whole pipeline, e.g. on a key press
+	pass
+
+
+class Stage:
+	def __init__(self, name, func, mode='thread'):
+		assert mode in MODES
+		self.name = name
+		self.func = func
+		self.mode = mode
+
+
+def _put(q, item, shedding, stats):
+	if item is _STOP or shedding == 'block' or getattr(item, 'keep', False):
+		q.put(item)
+		return
+	try:
+		q.put_nowait(item)
+		return
+	except queue.Full:
+		pass
+	stats['dropped'] += 1
+	if shedding == 'drop_oldest' and isinstance(q, queue.Queue):
+		# replace the oldest item in one step, so the consumer never sees the queue reordered
+		with q.mutex:
+			if q.queue and not getattr(q.queue[0], 'keep', False):
+				q.queue.popleft()
+				q.queue.append(item)
+				return
+		try:
+			q.put_nowait(item)  # the consumer emptied the queue meanwhile
+		except queue.Full:
+			pass  # the oldest is to be kept, the new item is dropped
+
+
+def _run(funcs, inq, outq, shedding, stop_event, stats):
+	# worker loop of a thread or process: funcs are the stage and the inline stages after it
+	stopped = False
+	while True:
+		item = inq.get()
+		if item is _STOP:
+			break
+		if stopped:
+			continue  # drain, so that the stages before this one are never blocked
+		try:
+			for func in funcs:
+				item = func(item)
+				if item is None:
+					break
+		except StopPipeline:
+			stop_event.set()
+			stopped = True
+			continue
+		except Exception:
+			traceback.print_exc()
+			stop_event.set()
+			stopped = True
+			continue
+		if item is not None and outq is not None:
+			_put(outq, item, shedding, stats)
+	for func in funcs:
+		if hasattr(func, 'close'):
+			func.close()
+	if outq is not None:
+		outq.put(_STOP)
+
+
+class Pipeline:
+	def __init__(self, stages, maxsize=2, shedding='block'):
+		assert shedding in SHEDDING
+		assert stages and stages[0].mode != 'inline'
+		self.maxsize = maxsize
+		self.shedding = shedding
+		self.stop_event = mp.Event()
+		self.stats = {'fed': 0, 'dropped': 0}  # items fed, items shed by the feeder and the thread stages
+
+		# group every stage with the inline stages following it, one worker per group
+		self._groups = []
+		for stage in stages:
+			if stage.mode == 'inline':
+				self._groups[-1][1].append(stage.func)
+			else:
+				self._groups.append((stage, [stage.func]))
+
+	def _queue(self, process):
+		return mp.Queue(self.maxsize) if process else queue.Queue(self.maxsize)
+
+	def run(self, source):
+		# feeds the items of the source iterable to the first stage until it ends or a stage stops the
+		# pipeline, then waits for every item to go through
+		process = [stage.mode == 'process' for stage, funcs in self._groups]
+		queues = [self._queue(process[i] or (i > 0 and process[i - 1])) for i in range(len(self._groups))]
+		workers = []
+		for i, (stage, funcs) in enumerate(self._groups):
+			outq = queues[i + 1] if i + 1 < len(queues) else None
+			if process[i]:
+				worker = mp.Process(target=_run, name=stage.name,
+									args=(funcs, queues[i], outq, self.shedding, self.stop_event, {'dropped': 0}))
+			else:
+				worker = threading.Thread(target=_run, name=stage.name,
+										  args=(funcs, queues[i], outq, self.shedding, self.stop_event, self.stats))
+			worker.start()
+			workers.append(worker)
+
+		try:
+			for item in source:
+				if self.stop_event.is_set():
+					break
+				self.stats['fed'] += 1
+				_put(queues[0], item, self.shedding, self.stats)
+		finally:
+			queues[0].put(_STOP)
+			for worker in workers:
+				worker.join()
+
+	def stop(self):
+		self.stop_event.set()
+
+
+class FrameScheduler:
+	# paces a stream at fps on monotonic deadlines, frame k being due one period after frame k - 1;
+	# a frame that ends after its deadline is counted as missed, and the next one gets a whole period
+	# from now instead of a shortened one, so a slow frame never makes the following ones rush
+	def __init__(self, fps):
+		self.period = 1. / fps
+		self.deadline = None
+		self.frames = 0
+		self.missed = 0
+
+	def next(self):
+		# seconds to wait for the deadline of the frame just ended, 0 when it was missed
+		now = time.monotonic()
+		if self.deadline is None:
+			self.deadline = now
+		self.deadline += self.period
+		self.frames += 1
+		delay = self.deadline - now
+		if delay < 0:
+			self.missed += 1
+			self.deadline = now
+			return 0.
+		return delay
@@ -0,0 +1,263 @@
+import functools
+from configparser import ConfigParser
+from dataclasses import MISSING, dataclass, fields
+
+# Settings
+# config.ini is parsed once into an immutable, typed snapshot: every value is converted and validated
+# by load(), which caches the result, so light.py, motion_detector.py and kcftracker.py share one
+# Settings object and their hot loops only read plain attributes.
+# A key without a default below must be in config.ini (see config_template.ini).
+
+config_filename = 'config.ini'
+
+ENGINES = ('bank', 'pool')
+FFT_BACKENDS = ('auto', 'cv2', 'numpy', 'numpy_real')
+BAD_TRACKING_POLICIES = ('retire', 'reseed')
+OVERFLOW_POLICIES = ('block', 'drop_newest', 'drop_oldest', 'caller_runs')
+PIPELINE_MODES = ('thread', 'process', 'inline')
+PIPELINE_SHEDDING = ('auto', 'block', 'drop_oldest', 'drop_newest')
+
+
+class SettingsError(ValueError):
+	pass
+
+
+def _check(condition, section, key, message):
+	if not condition:
+		raise SettingsError('[{}] {}: {}'.format(section, key, message))
+
+
+@dataclass(frozen=True)
+class LightSettings:
+	device_id: str
+	device_location: int
+	control_timer: int
+	cleanup_factor: float
+	deadline_factor: float
+	run_video: bool
+
+	def __post_init__(self):
+		_check(self.control_timer > 0, 'light', 'control_timer', 'must be positive')
+		_check(self.cleanup_factor > 0, 'light', 'cleanup_factor', 'must be positive')
+		_check(self.deadline_factor > 0, 'light', 'deadline_factor', 'must be positive')
+
+
+@dataclass(frozen=True)
+class MqttSettings:
+	endpoint_url: str
+	endpoint_port: int
+
+
+@dataclass(frozen=True)
+class ImgurSettings:
+	imgur_client_id: str
+	upload_img: bool
+
+
+@dataclass(frozen=True)
+class MotionSettings:
+	save_events: bool
+	camera_fov: float
+	camera_distance: float
+	image_width: int
+	frames_per_sec: float
+	sub_sampling: int
+
+	def __post_init__(self):
+		_check(self.image_width > 0, 'motion', 'image_width', 'must be positive')
+		_check(self.frames_per_sec > 0, 'motion', 'frames_per_sec', 'must be positive')
+		_check(self.sub_sampling > 0, 'motion', 'sub_sampling', 'must be positive')
+
+
+@dataclass(frozen=True)
+class DebugSettings:
+	debug: bool
+	imshow: bool
+	measure_time: bool
+	print_time: bool
+	headless: bool = False  # no window at all, e.g. on a node without a display
+
+
+@dataclass(frozen=True)
+class TrackerSettings:
+	resized: bool
+	window_padding: float
+	sigma_factor: float
+	interp_factor: float
+	sigma: float
+	min_movement: int
+	nonmoving_lifetime: int
+	bank_template_size: int = 32  # side of the square template every target of a KCFTrackerBank is resampled to
+	engine: str = 'bank'
+	pool_workers: int = 0  # 0: one per core but one
+	fft_backend: str = 'auto'
+	optimal_dft_size: bool = True
+	scale_interval: int = 3
+	scale_stability: float = 0.9
+	psr_threshold: float = 4.0
+	psr_sigmas: float = 3.0
+	psr_warmup: int = 10  # confident detections before the drop below the running mean is tested
+	psr_std_floor: float = 0.1  # floor of the PSR standard deviation, relative to the running mean
+	bad_tracking_lifetime: int = 3
+	bad_tracking_policy: str = 'retire'
+	motion_model: bool = True
+	velocity_gain: float = 0.5
+	velocity_limit: float = 0.25  # max predicted shift, as a fraction of the padded search window
+	entrance_margin: int = 10
+	entrance_size: int = 64
+
+	def __post_init__(self):
+		_check(self.window_padding > 0, 'tracker', 'window_padding', 'must be positive')
+		_check(0 < self.interp_factor <= 1, 'tracker', 'interp_factor', 'must be in (0, 1]')
+		_check(self.sigma > 0, 'tracker', 'sigma', 'must be positive')
+		_check(self.bank_template_size >= 8, 'tracker', 'bank_template_size', 'must be at least 8')
+		_check(self.engine in ENGINES, 'tracker', 'engine', 'must be one of {}'.format(ENGINES))
+		_check(self.pool_workers >= 0, 'tracker', 'pool_workers', 'must not be negative')
+		_check(self.fft_backend in FFT_BACKENDS, 'tracker', 'fft_backend', 'must be one of {}'.format(FFT_BACKENDS))
+		_check(self.scale_interval > 0, 'tracker', 'scale_interval', 'must be positive')
+		_check(self.psr_warmup > 1, 'tracker', 'psr_warmup', 'must be at least 2')
+		_check(self.psr_std_floor >= 0, 'tracker', 'psr_std_floor', 'must not be negative')
+		_check(self.bad_tracking_lifetime > 0, 'tracker', 'bad_tracking_lifetime', 'must be positive')
+		_check(self.bad_tracking_policy in BAD_TRACKING_POLICIES, 'tracker', 'bad_tracking_policy',
+			   'must be one of {}'.format(BAD_TRACKING_POLICIES))
+		_check(0 <= self.velocity_gain <= 1, 'tracker', 'velocity_gain', 'must be in [0, 1]')
+		_check(0 <= self.velocity_limit <= 0.5, 'tracker', 'velocity_limit', 'must be in [0, 0.5]')
+		_check(self.entrance_margin >= 0, 'tracker', 'entrance_margin', 'must not be negative')
+		_check(self.entrance_size >= 0, 'tracker', 'entrance_size', 'must not be negative')
+
+
+@dataclass(frozen=True)
+class DetectionSettings:
+	absdiff_threshold: int
+	person_aspect_ratio: float
+	alpha_blending: float
+	closing_kernel_width: int
+	closing_kernel_height: int
+	margins_ignorance_detection: int
+	margins_ignorance_decision: int
+	min_blob_area: int
+	gaussian_width: int
+	detection_level: int = 0  # 0: full frame, 1: half size, 2: quarter size...
+	association_iou: float = 0.0
+	unsupported_lifetime: int = 10  # 0: never remove a tracker for lack of detections
+	gate_step: int = 8  # pixels between the samples of the idle frame gate, 0: no gate
+	gate_threshold: float = 0.002  # fraction of changed samples up to which a frame is idle
+	detection_interval: int = 4  # frames between full frame detections while all trackers are settled
+	entry_zone: int = 80  # pixels at the left and right margins searched on the frames in between
+	cadence_change: float = 0.01  # rise of the gate change score that brings back a full frame detection
+
+	def __post_init__(self):
+		_check(0 <= self.absdiff_threshold <= 255, 'detection', 'absdiff_threshold', 'must be in [0, 255]')
+		_check(self.closing_kernel_width > 0, 'detection', 'closing_kernel_width', 'must be positive')
+		_check(self.closing_kernel_height > 0, 'detection', 'closing_kernel_height', 'must be positive')
+		_check(self.gaussian_width > 0 and self.gaussian_width % 2 == 1, 'detection', 'gaussian_width',
+			   'must be positive and odd')
+		_check(0 <= self.detection_level <= 3, 'detection', 'detection_level', 'must be in [0, 3]')
+		_check(0 <= self.association_iou < 1, 'detection', 'association_iou', 'must be in [0, 1)')
+		_check(self.unsupported_lifetime >= 0, 'detection', 'unsupported_lifetime', 'must not be negative')
+		_check(self.gate_step >= 0, 'detection', 'gate_step', 'must not be negative')
+		_check(0 <= self.gate_threshold < 1, 'detection', 'gate_threshold', 'must be in [0, 1)')
+		_check(self.detection_interval > 0, 'detection', 'detection_interval', 'must be positive')
+		_check(self.entry_zone > 0, 'detection', 'entry_zone', 'must be positive')
+		_check(self.cadence_change >= 0, 'detection', 'cadence_change', 'must not be negative')
+
+
+@dataclass(frozen=True)
+class PipelineSettings:
+	preprocess: str = 'thread'
+	track: str = 'thread'
+	emit: str = 'thread'  # not in a process: the motion events (cb) go out of the process that runs md()
+	queue_size: int = 2
+	shedding: str = 'auto'  # auto: block for a video file, drop_oldest for the camera
+	buffer_pool: bool = True  # preprocessing images allocated once and reused
+
+	def __post_init__(self):
+		_check(self.preprocess in PIPELINE_MODES[:2], 'pipeline', 'preprocess',
+			   'must be one of {}'.format(PIPELINE_MODES[:2]))
+		_check(self.track in PIPELINE_MODES, 'pipeline', 'track', 'must be one of {}'.format(PIPELINE_MODES))
+		emit_modes = (PIPELINE_MODES[0], PIPELINE_MODES[2])
+		_check(self.emit in emit_modes, 'pipeline', 'emit', 'must be one of {}'.format(emit_modes))
+		# an inline stage runs in the worker of the stage before it
+		in_process = self.track == 'process' or (self.track == 'inline' and self.preprocess == 'process')
+		_check(self.emit != 'inline' or not in_process, 'pipeline', 'emit', 'must not be inline after a process stage')
+		_check(self.queue_size > 0, 'pipeline', 'queue_size', 'must be positive')
+		_check(self.shedding in PIPELINE_SHEDDING, 'pipeline', 'shedding', 'must be one of {}'.format(PIPELINE_SHEDDING))
+
+
+@dataclass(frozen=True)
+class SnapshotSettings:
+	directory: str = 'images'
+	workers: int = 1
+	queue_size: int = 4  # snapshots waiting to be written, more are dropped
+	crop: bool = True  # the target and a margin around it only
+	max_width: int = 0  # wider snapshots are scaled down, 0: never
+	jpeg_quality: int = 90
+
+	def __post_init__(self):
+		_check(self.workers > 0, 'snapshot', 'workers', 'must be positive')
+		_check(self.queue_size > 0, 'snapshot', 'queue_size', 'must be positive')
+		_check(self.max_width >= 0, 'snapshot', 'max_width', 'must not be negative')
+		_check(0 <= self.jpeg_quality <= 100, 'snapshot', 'jpeg_quality', 'must be in [0, 100]')
+
+
+@dataclass(frozen=True)
+class ExecutorSettings:
+	# the named executors of executors.py: motion callbacks, image uploads and outbound MQTT messages
+	events_workers: int = 1
+	events_queue_size: int = 16
+	events_overflow: str = 'block'
+	upload_workers: int = 1
+	upload_queue_size: int = 8
+	upload_overflow: str = 'drop_oldest'
+	publish_workers: int = 1  # one, the messages go out in order
+	publish_queue_size: int = 64
+	publish_overflow: str = 'drop_oldest'
+
+	def __post_init__(self):
+		for name in ('events', 'upload', 'publish'):
+			_check(getattr(self, name + '_workers') > 0, 'executors', name + '_workers', 'must be positive')
+			_check(getattr(self, name + '_queue_size') > 0, 'executors', name + '_queue_size', 'must be positive')
+			_check(getattr(self, name + '_overflow') in OVERFLOW_POLICIES, 'executors', name + '_overflow',
+				   'must be one of {}'.format(OVERFLOW_POLICIES))
+
+
+@dataclass(frozen=True)
+class Settings:
+	light: LightSettings
+	mqtt: MqttSettings
+	imgur: ImgurSettings
+	motion: MotionSettings
+	debug: DebugSettings
+	tracker: TrackerSettings
+	detection: DetectionSettings
+	pipeline: PipelineSettings
+	snapshot: SnapshotSettings
+	executors: ExecutorSettings
+
+
+def _section(config_parser, section, cls):
+	getters = {bool: config_parser.getboolean, int: config_parser.getint, float: config_parser.getfloat,
+			   str: config_parser.get}
+	values = {}
+	for field in fields(cls):
+		if not config_parser.has_option(section, field.name):
+			_check(field.default is not MISSING, section, field.name, 'missing')
+			continue
+		try:
+			values[field.name] = getters[field.type](section, field.name)
+		except ValueError as e:
+			raise SettingsError('[{}] {}: {}'.format(section, field.name, e))
+	return cls(**values)
+
+
+def parse(config_parser):
+	return Settings(**{field.name: _section(config_parser, field.name, field.type) for field in fields(Settings)})
+
+
+@functools.lru_cache(maxsize=None)
+def load(filename=config_filename):
+	# the settings of filename, read from disk on the first call only
+	config_parser = ConfigParser()
+	if not config_parser.read(filename):
+		raise SettingsError('cannot read {}'.format(filename))
+	return parse(config_parser)
@@ -0,0 +1,72 @@
+import os
+import traceback
+import cv2
+import executors
+
+# Snapshot writer
+# Event snapshots are cropped around the target, scaled down, JPEG encoded and written to disk on the
+# 'snapshot' executor (OpenCV releases the GIL while encoding), so the vision loop only hands a frame over.
+# Its queue is bounded: when it is full a snapshot is dropped rather than waited for, and its event goes
+# out without an image.
+
+
+def cropRoi(image, roi, margin=50):
+	rows = image.shape[0];
+	cols = image.shape[1];
+	x = roi[0];
+	y = roi[1];
+	w = roi[2];
+	h = roi[3]
+	to_x = min(x + w + margin, cols - 1)
+	to_y = min(y + h + margin, rows - 1)
+	x = max(0, x - margin)
+	y = max(0, y - margin)
+	return image[y:to_y, x:to_x]
+
+
+class SnapshotWriter:
+	def __init__(self, directory='images', workers=1, queue_size=4, crop=True, max_width=0, jpeg_quality=90):
+		# crop: keep only the target roi and a margin around it, max_width: scale wider images down to it
+		# (0: never)
+		self.directory = directory
+		self.crop = crop
+		self.max_width = max_width
+		self.jpeg_quality = jpeg_quality
+		self.written = 0
+		self.executor = executors.BoundedExecutor('snapshot', workers, queue_size, 'drop_newest')
+
+	@property
+	def dropped(self):
+		return self.executor.dropped
+
+	def submit(self, frame, roi, name, done):
+		# queues a snapshot of frame around roi (full frame x, y, w, h, or None for the whole frame), written as
+		# <directory>/<name>.jpg; a worker calls done(path) once it is written, done(None) if it failed, and
+		# done(None) is called right away when the queue is full; the frame must not change until then
+		return self.executor.submit(self._job, frame, roi, name, done, dropped=lambda: done(None))
+
+	def _job(self, frame, roi, name, done):
+		path = None
+		try:
+			path = self._write(frame, roi, name)
+		except Exception:
+			traceback.print_exc()
+		done(path)
+
+	def _write(self, image, roi, name):
+		if self.crop and roi is not None:
+			image = cropRoi(image, [int(v) for v in roi])
+		if self.max_width and image.shape[1] > self.max_width:
+			scale = self.max_width / float(image.shape[1])
+			image = cv2.resize(image, None, fx=scale, fy=scale, interpolation=cv2.INTER_AREA)
+		(encoded, jpeg) = cv2.imencode('.jpg', image, [cv2.IMWRITE_JPEG_QUALITY, self.jpeg_quality])
+		if not encoded:
+			raise ValueError('cannot encode snapshot {}'.format(name))
+		path = os.path.join(self.directory, name + '.jpg')
+		jpeg.tofile(path)
+		self.written += 1
+		return path
+
+	def close(self):
+		# writes the queued snapshots, then stops the workers
+		self.executor.shutdown()